@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import hashlib
+import os
+from argparse import ArgumentParser
+from datetime import datetime
+from statistics import mean, median
+from time import perf_counter
+from typing import List
+
+if __name__ == "__main__":
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hubmap_query.settings")
+    django.setup()
+
+from query_app.handle_store import (
+    MongoHandleStore,
+    RedisHandleStore,
+    SQLiteHandleStore,
+)
+
+
+def make_docs(count: int, pickle_size: int) -> List[dict]:
+    docs = []
+    for i in range(count):
+        query_pickle = os.urandom(pickle_size)
+        docs.append(
+            {
+                "query_handle": hashlib.sha256(query_pickle).hexdigest(),
+                "query_pickle": query_pickle,
+                "set_type": "cell",
+                "created_at": datetime.utcnow(),
+            }
+        )
+    return docs
+
+
+def time_calls(function, args_list) -> List[float]:
+    times = []
+    for args in args_list:
+        start = perf_counter()
+        function(*args)
+        times.append(perf_counter() - start)
+    return times
+
+
+def summarize(name: str, times: List[float]):
+    times_ms = [t * 1000 for t in times]
+    print(f"\t{name}: mean {mean(times_ms):.3f} ms, median {median(times_ms):.3f} ms")
+
+
+def benchmark(handle_store, docs: List[dict]):
+    print(handle_store.name)
+    handle_store.set_up()
+    summarize("put", time_calls(handle_store.put, [(doc,) for doc in docs]))
+    summarize("put existing", time_calls(handle_store.put, [(doc,) for doc in docs]))
+    summarize("get", time_calls(handle_store.get, [(doc["query_handle"],) for doc in docs]))
+    summarize("get missing", time_calls(handle_store.get, [(str(i),) for i in range(len(docs))]))
+
+
+def main(backends: List[str], count: int, pickle_size: int, redis_url: str, sqlite_path: str):
+    handle_stores = {
+        "mongo": lambda: MongoHandleStore({}),
+        "redis": lambda: RedisHandleStore({"LOCATION": redis_url}),
+        "sqlite": lambda: SQLiteHandleStore({"LOCATION": sqlite_path}),
+    }
+    docs = make_docs(count, pickle_size)
+    for backend in backends:
+        benchmark(handle_stores[backend](), docs)
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument("backends", choices=["mongo", "redis", "sqlite"], nargs="+")
+    p.add_argument("--count", type=int, default=1000)
+    p.add_argument("--pickle-size", type=int, default=4096)
+    p.add_argument("--redis-url", default="redis://redis:6379/1")
+    p.add_argument("--sqlite-path", default="/tmp/handle_store_benchmark.sqlite3")
+    args = p.parse_args()
+
+    main(args.backends, args.count, args.pickle_size, args.redis_url, args.sqlite_path)
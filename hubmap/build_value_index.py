@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import zarr
+
+from query_app.zarr_groups import SORTED_GROUP, SUMMARY_GROUP, SUMMARY_MOMENTS
+
+
+def build_value_index(root: zarr.Group, modality: str, var_id: str):
+    """For one quantitative array, stores its values in ascending order (NaN last)
+    along with the row position of each value, so that threshold queries can binary
+    search instead of scanning the whole array"""
+    array = root[f"{modality}/{var_id}"]
+    values = array[:]
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+    chunk_length = array.chunks[0]
+
+    index = root.require_group(f"{SORTED_GROUP}/{modality}/{var_id}")
+    index.array("values", sorted_values, chunks=(chunk_length,), overwrite=True)
+    index.array("positions", order.astype(np.int64), chunks=(chunk_length,), overwrite=True)
+    # First value of each chunk, small enough to be read whole to find the chunk to search
+    index.array("fences", sorted_values[::chunk_length], overwrite=True)
+    index.attrs["valid_count"] = int(np.count_nonzero(~np.isnan(sorted_values)))
+
+
+def build_chunk_summaries(root: zarr.Group, modality: str, var_id: str):
+    """For each zarr chunk of one quantitative array, stores the count, mean, sum of squared
+    deviations from the mean, min and max of its non-NaN values, so that statistics over sets
+    covering whole chunks don't need to read them"""
+    array = root[f"{modality}/{var_id}"]
+    chunk_length = array.chunks[0]
+    chunk_count = array.nchunks
+    values = np.full(chunk_count * chunk_length, np.nan)
+    values[: len(array)] = array[:]
+    chunks = values.reshape(chunk_count, chunk_length)
+    valid = ~np.isnan(chunks)
+
+    summaries = np.empty((chunk_count, len(SUMMARY_MOMENTS)))
+    counts = valid.sum(axis=1)
+    means = np.where(valid, chunks, 0.0).sum(axis=1) / np.maximum(counts, 1)
+    summaries[:, 0] = counts
+    summaries[:, 1] = means
+    summaries[:, 2] = np.where(valid, np.square(chunks - means[:, np.newaxis]), 0.0).sum(axis=1)
+    # fmin and fmax skip NaN, and give NaN only for chunks without any value
+    summaries[:, 3] = np.fmin.reduce(chunks, axis=1)
+    summaries[:, 4] = np.fmax.reduce(chunks, axis=1)
+
+    group = root.require_group(f"{SUMMARY_GROUP}/{modality}")
+    summary_array = group.array(var_id, summaries, overwrite=True)
+    summary_array.attrs["chunk_length"] = chunk_length
+    summary_array.attrs["moments"] = SUMMARY_MOMENTS
+
+
+def main(zarr_path: Path, modalities: List[str]):
+    root = zarr.open(str(zarr_path), mode="a")
+    for modality in modalities:
+        if modality not in root:
+            print(f"{modality} not found in {zarr_path}")
+            continue
+        var_ids = [name for name, array in root[modality].arrays()]
+        for var_id in var_ids:
+            build_value_index(root, modality, var_id)
+            build_chunk_summaries(root, modality, var_id)
+        print(f"{len(var_ids)} {modality} value indices and chunk summaries built")
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument("zarr_path", type=Path, nargs="?", default=Path("/opt/data/zarr/example.zarr"))
+    p.add_argument("--modalities", nargs="+", default=["rna", "atac", "codex"])
+    args = p.parse_args()
+
+    main(args.zarr_path, args.modalities)
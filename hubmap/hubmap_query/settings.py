@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import sys
 from datetime import timedelta
-from os import fspath
+from os import environ, fspath
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -35,6 +35,26 @@ MONGO_PORT = "27017"
 MONGO_DB_NAME = "token_store"
 MONGO_COLLECTION_NAME = "pickles_and_hashes"
 TOKEN_EXPIRATION_TIME = 14400  # 4 hours in seconds
+# Backend persisting query handles, one of MongoHandleStore, RedisHandleStore
+# (with "LOCATION": "redis://redis:6379/1") or SQLiteHandleStore (with "LOCATION"
+# set to a database file path) from query_app.handle_store
+HANDLE_STORE = {
+    "BACKEND": "query_app.handle_store.MongoHandleStore",
+}
+# Connection pool of the shared, per-process Mongo client
+MONGO_MAX_POOL_SIZE = 8
+MONGO_MIN_POOL_SIZE = 1
+MONGO_MAX_IDLE_TIME_MS = 5 * 60 * 1000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 10 * 1000
+# Per-process cache of decoded handles, entries expire with TOKEN_EXPIRATION_TIME
+HANDLE_CACHE_MAX_ENTRIES = 256
+HANDLE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Per-process cache of cell handles sorted by the values of a gene or protein
+SORTED_HANDLE_CACHE_MAX_ENTRIES = 32
+SORTED_HANDLE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Per-process cache of the cells meeting quantitative conditions
+CONDITION_PKS_CACHE_MAX_ENTRIES = 32
+CONDITION_PKS_CACHE_MAX_BYTES = 256 * 1024 * 1024
 
 CELERY_BROKER_URL = "redis://redis:6379"
 CELERY_TIMEZONE = "America/New_York"
@@ -46,6 +66,23 @@ QUERY_TOKEN_EXPIRATION = timedelta(days=1)
 # Faster app startup for testing
 SKIP_LOADING_PVALUES = False
 MAX_PAGE_SIZE = 200000
+# Number of records evaluated at a time when evaluations are streamed as NDJSON
+STREAM_BATCH_SIZE = 10000
+# Reference tables are read from their HDF5/h5ad sources on first use, then cached here
+# in formats that later processes memory-map instead of parsing; None disables the cache
+DATA_CACHE_DIR = "/opt/data/cache"
+# Cell counts of the per-dataset and per-modality handles, rebuilt when the data changes
+HANDLE_MANIFEST_PATH = "/opt/data/dataset_handles.json"
+# Load every reference table in QueryAppConfig.ready instead of on first use. Under uwsgi,
+# which loads the app in the master unless lazy-apps is set, workers then share the tables
+PRELOAD_TABLES = environ.get("PRELOAD_TABLES", "false").lower() == "true"
+
+# Cell handles also store their member primary keys, so that counts and evaluations
+# don't need to re-run the query; sets that compress larger than this stay query-only
+MATERIALIZE_CELL_HANDLES = True
+MAX_MATERIALIZED_CELL_BYTES = 8 * 1024 * 1024
+# Count handles that aren't materialized in a Celery task as soon as they are created
+ASYNC_HANDLE_COUNTS = False
 
 # database is local to each web app instance, not worth overriding
 # credentials for production deployment at the moment
@@ -3,6 +3,11 @@ Settings for testing under Travis CI. Notably, connect to a local database
 instead of one provided by `docker-compose`.
 """
 
+import atexit
+import os
+import shutil
+import tempfile
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql_psycopg2",
@@ -25,4 +30,13 @@ MONGO_DB_NAME = "token_store"
 MONGO_COLLECTION_NAME = "pickles_and_hashes"
 TOKEN_EXPIRATION_TIME = 14400  # 4 hours in seconds
 
+# A fresh handle store for each test run, handles left over from earlier runs (or earlier
+# fixtures) would otherwise be found again under the same query hashes
+HANDLE_STORE_DIR = tempfile.mkdtemp(prefix="hubmap_query_test_")
+atexit.register(shutil.rmtree, HANDLE_STORE_DIR, ignore_errors=True)
+HANDLE_STORE = {
+    "BACKEND": "query_app.handle_store.SQLiteHandleStore",
+    "LOCATION": os.path.join(HANDLE_STORE_DIR, "handles.sqlite3"),
+}
+
 MONGO_HOST_AND_PORT = f"mongodb://{MONGO_USERNAME}:{MONGO_PASSWORD}@{MONGO_HOSTNAME}:{MONGO_PORT}/"
@@ -1,21 +1,17 @@
 from statistics import mean, stdev
-from typing import List
+from typing import Dict, List, Optional
 
 import numpy as np
 
-from .apps import (
-    atac_cell_df,
-    atac_gene_df,
-    codex_cell_df,
-    codex_gene_df,
-    rna_cell_df,
-    rna_gene_df,
-    zarr_root,
+from .cell_index import pks_to_positions, read_quant_values
+from .data_registry import get_table
+from .set_evaluators import get_handle_cell_pks
+from .validation import (
+    validate_batch_statistic_args,
+    validate_bounds_args,
+    validate_statistic_args,
 )
-from .utils import unpickle_query_set
-from .validation import validate_bounds_args, validate_statistic_args
-
-cell_dfs_dict = {"atac": atac_cell_df, "codex": codex_cell_df, "rna": rna_cell_df}
+from .zarr_groups import SUMMARY_GROUP, SUMMARY_MOMENTS
 
 
 def check_list(vals_list):
@@ -33,54 +29,129 @@ def check_list(vals_list):
     return good_vals
 
 
-def get_data(modality: str, var_id: str, cell_ids: List[str]):
-    bool_mask = cell_df.cell_id.isin(cell_ids)
-    a = zarr_root[f"/{modality}/{var_id}/"][bool_mask]
-    return a
+def get_positions(cell_pks: np.ndarray) -> Dict[str, np.ndarray]:
+    """np.ndarray -> Dict[str, np.ndarray]
+    Row positions of a set of cells in the zarr arrays of each modality"""
+    return {
+        modality: pks_to_positions(modality, cell_pks)[1] for modality in ["codex", "rna", "atac"]
+    }
+
+
+# Moments are [count, mean, sum of squared deviations from the mean, min, max] over the
+# non-NaN values, the same layout as the chunk summaries written by build_value_index.py.
+# Unlike a sum of squares, the squared deviations don't cancel out when the variance
+# is small next to the mean
+empty_moments = np.array([0.0, 0.0, 0.0, np.nan, np.nan])
+
+
+def get_moments(a: np.ndarray) -> np.ndarray:
+    a = a[~np.isnan(a)]
+    if len(a) == 0:
+        return empty_moments
+    mean_value = a.mean()
+    return np.array([len(a), mean_value, np.square(a - mean_value).sum(), a.min(), a.max()])
+
+
+def combine_moments(moments: np.ndarray) -> np.ndarray:
+    """np.ndarray -> np.ndarray
+    Merges the rows of a (n, 5) array of moments into the moments of all their values,
+    with Chan et al.'s parallel variance formula generalized to n parts"""
+    moments = moments[moments[:, 0] > 0]
+    if len(moments) == 0:
+        return empty_moments
+    counts, means, m2s = moments[:, 0], moments[:, 1], moments[:, 2]
+    count = counts.sum()
+    mean_value = (counts * means).sum() / count
+    m2 = m2s.sum() + (counts * np.square(means - mean_value)).sum()
+    return np.array([count, mean_value, m2, moments[:, 3].min(), moments[:, 4].max()])
+
+
+def get_var_moments(modality: str, var_id: str, positions: np.ndarray) -> np.ndarray:
+    """str, str, np.ndarray -> np.ndarray
+    Moments of a gene or protein over a set of row positions. Zarr chunks the positions cover
+    entirely are taken from the precomputed chunk summaries, if any, so that only the chunks
+    at the edges of the set are read"""
+    try:
+        zarr_root = get_table("zarr_root")
+        array = zarr_root[f"/{modality}/{var_id}"]
+        summaries = zarr_root[f"/{SUMMARY_GROUP}/{modality}/{var_id}"]
+    except KeyError:
+        return get_moments(read_quant_values(modality, var_id, positions))
+
+    chunk_length = array.chunks[0]
+    chunk_count = summaries.shape[0]
+    if (
+        summaries.attrs.get("chunk_length") != chunk_length
+        or summaries.attrs.get("moments") != SUMMARY_MOMENTS
+        or chunk_count != array.nchunks
+    ):
+        # Summaries left over from before the array was rewritten, or in an older layout
+        return get_moments(read_quant_values(modality, var_id, positions))
+
+    # Cells sharing a cell ID share a row position, so a chunk is covered by its distinct
+    # positions, and any further occurrences of them are read along with the edge chunks
+    unique_positions, position_counts = np.unique(positions, return_counts=True)
+    unique_chunk_ids = unique_positions // chunk_length
+    chunk_sizes = np.minimum(chunk_length, len(array) - np.arange(chunk_count) * chunk_length)
+    full_chunks = np.bincount(unique_chunk_ids, minlength=chunk_count) == chunk_sizes
+    in_full_chunk = full_chunks[unique_chunk_ids]
+    edge_positions = np.concatenate(
+        [
+            positions[~full_chunks[positions // chunk_length]],
+            np.repeat(unique_positions[in_full_chunk], position_counts[in_full_chunk] - 1),
+        ]
+    )
 
+    moments = [get_moments(read_quant_values(modality, var_id, edge_positions))]
+    if full_chunks.any():
+        moments.extend(summaries[:][full_chunks])
+    return combine_moments(np.vstack(moments))
 
-def get_statistic_value(a, stat_type):
+
+def get_statistic_value(moments: np.ndarray, stat_type: str) -> Optional[float]:
+    # Cells without a value are left out; with no values at all there is no statistic
+    count, mean_value, m2, minimum, maximum = moments
+    if count == 0:
+        return None
     if stat_type == "mean":
-        value = a.mean()
+        value = mean_value
     elif stat_type == "min":
-        value = a.min()
+        value = minimum
     elif stat_type == "max":
-        value = adata.X.max()
+        value = maximum
     elif stat_type == "stddev":
-        value = adata.X.std()
+        value = np.sqrt(m2 / count)
 
     return float(value)
 
 
-def get_stat_values(query_set, var_id, stat_type):
-
-    codex_cells = list(
-        query_set.filter(modality__modality_name="codex").values_list("cell_id", flat=True)
-    )
-    rna_cells = list(
-        query_set.filter(modality__modality_name="rna").values_list("cell_id", flat=True)
-    )
-    atac_cells = list(
-        query_set.filter(modality__modality_name="atac").values_list("cell_id", flat=True)
+def get_stat_matrices(positions, var_ids: List[str], stat_types: List[str]):
+    """Dict[str, np.ndarray], List[str], List[str] -> Dict[str, List[List[Optional[float]]]]
+    For each modality, a var_ids x stat_types matrix of statistics. The moments of each
+    gene or protein are gathered once, and every requested statistic is derived from them"""
+    stat_matrices = {}
+    for modality, modality_positions in positions.items():
+        stat_matrices[modality] = []
+        for var_id in var_ids:
+            moments = get_var_moments(modality, var_id, modality_positions)
+            stat_matrices[modality].append(
+                [get_statistic_value(moments, stat_type) for stat_type in stat_types]
+            )
+    return stat_matrices
+
+
+def get_stat_values(cell_pks, var_id, stat_type):
+    stat_matrices = get_stat_matrices(get_positions(cell_pks), [var_id], [stat_type])
+    codex_value, rna_value, atac_value = (
+        stat_matrices[modality][0][0] for modality in ["codex", "rna", "atac"]
     )
-
-    print("Cells for each modality found")
-
-    codex_array = get_data("codex", var_id, codex_cells)
-    rna_array = get_data("rna", var_id, rna_cells)
-    atac_array = get_data("atac", var_id, atac_cells)
-
-    codex_value = get_statistic_value(codex_array, stat_type)
-    rna_value = get_statistic_value(rna_array, stat_type)
-    atac_value = get_statistic_value(atac_array, stat_type)
-
     return codex_value, rna_value, atac_value
 
 
 def calc_stats(query_handle, set_type, var_id, stat_type):
     print(f"Calc stats called")
-    query_set = unpickle_query_set(query_handle)[0]
-    codex_value, rna_value, atac_value = get_stat_values(query_set, var_id, stat_type)
+    cell_pks = get_handle_cell_pks(query_handle)
+    codex_value, rna_value, atac_value = get_stat_values(cell_pks, var_id, stat_type)
     stat_report_dict = {
         "query_handle": query_handle,
         "var_id": var_id,
@@ -116,13 +187,45 @@ def calculate_statistics(self, request):
     return stat_report_dict
 
 
+def calc_batch_stats(query_handle, set_type, var_ids, stat_types):
+    stat_matrices = get_stat_matrices(
+        get_positions(get_handle_cell_pks(query_handle)), var_ids, stat_types
+    )
+    stat_report_dict = {
+        "query_handle": query_handle,
+        "var_ids": var_ids,
+        "statistic_types": stat_types,
+        "rna_values": stat_matrices["rna"],
+        "atac_values": stat_matrices["atac"],
+        "codex_values": stat_matrices["codex"],
+    }
+
+    response_dict = {}
+
+    response_dict["count"] = 1
+    response_dict["next"] = None
+    response_dict["previous"] = None
+    response_dict["results"] = [stat_report_dict]
+
+    return response_dict
+
+
+def calculate_batch_statistics(self, request):
+    query_params = request.data.dict()
+    query_params["var_ids"] = request.POST.getlist("var_ids")
+    query_params["stat_types"] = request.POST.getlist("stat_types")
+
+    query_handle, set_type, var_ids, stat_types = validate_batch_statistic_args(query_params)
+
+    return calc_batch_stats(query_handle, set_type, var_ids, stat_types)
+
+
 def get_bounds(self, request):
     query_params = request.data.dict()
     validate_bounds_args(query_params)
     modality = query_params["modality"]
 
-    gene_dfs_dict = {"atac": atac_gene_df, "codex": codex_gene_df, "rna": rna_gene_df}
-    gene_df = gene_dfs_dict[modality]
+    gene_df = get_table(f"{modality}_gene_df")
 
     if "var_id" in query_params.keys():
         min_value = gene_df.at[query_params["var_id"], "min"]
@@ -1,6 +1,10 @@
+import gc
 import hashlib
+import json
+import os
 import pickle
 from datetime import datetime
+from functools import partial
 from os import fspath
 from pathlib import Path
 
@@ -9,11 +13,15 @@ import pandas as pd
 import zarr
 from django.apps import AppConfig
 from django.conf import settings
+from django.db import connections
 from django.db.utils import ProgrammingError
-from pymongo import MongoClient
 from tables.exceptions import HDF5ExtError
 from zarr.errors import PathNotFoundError
 
+from .data_registry import data_registry
+from .handle_store import get_handle_store
+from .timing import get_phase_timings, timed_phase
+
 PATH_TO_H5AD_FILES = Path("/opt")
 PATH_TO_CODEX_H5AD = PATH_TO_H5AD_FILES / "codex.h5ad"
 PATH_TO_RNA_H5AD = PATH_TO_H5AD_FILES / "rna.h5ad"
@@ -24,13 +32,16 @@ PATH_TO_CODEX_PVALS = PATH_TO_H5AD_FILES / "codex.hdf5"
 PATH_TO_RNA_PERCENTAGES = PATH_TO_H5AD_FILES / "rna_precompute.hdf5"
 PATH_TO_ATAC_PERCENTAGES = PATH_TO_H5AD_FILES / "atac_precompute.hdf5"
 PATH_TO_CODEX_PERCENTAGES = PATH_TO_H5AD_FILES / "codex_precompute.hdf5"
+PATH_TO_ATAC_ORGAN_PVALS = PATH_TO_H5AD_FILES / "atac_organ.h5ad"
+PATH_TO_ATAC_CLUSTER_PVALS = PATH_TO_H5AD_FILES / "atac_cluster.h5ad"
+PATH_TO_ZARR = Path("/opt/data/zarr/example.zarr")
 
 
 def get_atac_pvals():
     try:
-        organ_adata = anndata.read(PATH_TO_H5AD_FILES / "atac_organ.h5ad")
+        organ_adata = anndata.read(PATH_TO_ATAC_ORGAN_PVALS)
         organ_adata.obs["grouping_type"] = "organ"
-        cluster_adata = anndata.read(PATH_TO_H5AD_FILES / "atac_cluster.h5ad")
+        cluster_adata = anndata.read(PATH_TO_ATAC_CLUSTER_PVALS)
         cluster_adata.obs["grouping_type"] = "cluster"
         adata = anndata.concat([organ_adata, cluster_adata])
     except FileNotFoundError:
@@ -38,10 +49,7 @@ def get_atac_pvals():
     return adata
 
 
-def make_pickle_and_hash(qs, set_type):
-    client = MongoClient(settings.MONGO_HOST_AND_PORT)
-    collection = client[settings.MONGO_DB_NAME][settings.MONGO_COLLECTION_NAME]
-
+def make_handle_doc(qs, set_type):
     qry = qs.query
     query_pickle = pickle.dumps(qry)
     query_handle = str(hashlib.sha256(query_pickle).hexdigest())
@@ -52,50 +60,114 @@ def make_pickle_and_hash(qs, set_type):
         "set_type": set_type,
         "created_at": datetime.utcnow(),
     }
-    collection.insert_one(doc)
+    return doc
+
 
-    return query_handle
+def set_up_handle_store():
+    handle_store = get_handle_store()
+    print(f"Handle store: {handle_store.name}")
+    handle_store.set_up()
 
 
-def set_up_mongo():
-    print(settings.MONGO_HOST_AND_PORT)
-    client = MongoClient(settings.MONGO_HOST_AND_PORT)
-    db = client[settings.MONGO_DB_NAME][settings.MONGO_COLLECTION_NAME]
-    db.create_index("created_at", expireAfterSeconds=settings.TOKEN_EXPIRATION_TIME)
-    #    db.log_events.createIndex({"created_at": 1}, {expireAfterSeconds: TOKEN_EXPIRATION_TIME})
+def get_data_version(datasets, modalities) -> str:
+    """List[str], List[str] -> str
+    Changes whenever the datasets and modalities in the database, or the files they were loaded
+    from, do"""
+    file_stats = []
+    for path in [PATH_TO_RNA_PVALS, PATH_TO_ATAC_PVALS, PATH_TO_CODEX_PVALS]:
+        try:
+            stat = path.stat()
+            file_stats.append([fspath(path), stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            file_stats.append([fspath(path), None, None])
+    version_json = json.dumps([datasets, modalities, file_stats])
+    return hashlib.sha256(version_json.encode()).hexdigest()
 
 
-def compute_dataset_hashes():
+def read_handle_manifest(data_version):
+    """str -> Optional[Dict[Tuple[str, str], int]]
+    Cell counts of the dataset and modality handles, keyed by (kind, name),
+    if the manifest was written for this data version"""
+    if settings.HANDLE_MANIFEST_PATH is None:
+        return None
+    try:
+        with open(settings.HANDLE_MANIFEST_PATH) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if manifest.get("data_version") != data_version:
+        return None
+    return {(handle["kind"], handle["name"]): handle["count"] for handle in manifest["handles"]}
+
+
+def write_handle_manifest(data_version, counts):
+    if settings.HANDLE_MANIFEST_PATH is None:
+        return
+    manifest = {
+        "data_version": data_version,
+        "handles": [
+            {"kind": kind, "name": name, "count": count} for (kind, name), count in counts.items()
+        ],
+    }
+    manifest_path = Path(settings.HANDLE_MANIFEST_PATH)
+    temp_path = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.tmp")
+    try:
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, manifest_path)
+    except OSError as e:
+        print(f"Couldn't write handle manifest {manifest_path}: {e}")
+
+
+def compute_dataset_hashes(rebuild=False):
+    """Registers a cell handle for each dataset and each modality. Their cell counts are read
+    from the handle manifest when it matches the data version, and are only computed (and the
+    manifest rewritten) when the data changes or rebuild is set"""
     from .models import Cell, Dataset, Modality
 
     hash_dict = {}
     uuid_dict = {}
     count_dict = {}
     try:
-        for uuid in Dataset.objects.all().values_list("uuid", flat=True):
-            print(uuid)
-            query_set = Cell.objects.filter(dataset__uuid__in=[uuid]).distinct("cell_id")
-            print(query_set.query)
-            hash = make_pickle_and_hash(query_set, "cell")
-            print(hash)
-            hash_dict[hash] = uuid
-            uuid_dict[uuid] = hash
-            count_dict[hash] = query_set.count()
-
-        for modality in Modality.objects.all().values_list("modality_name", flat=True):
-            print(modality)
-            query_set = Cell.objects.filter(modality__modality_name__in=[modality]).distinct(
-                "cell_id"
-            )
-            print(query_set.query)
-            hash = make_pickle_and_hash(query_set, "cell")
-            print(hash)
-            hash_dict[hash] = modality
-            uuid_dict[modality] = hash
-            count_dict[hash] = query_set.count()
+        datasets = list(Dataset.objects.order_by("uuid").values_list("uuid", flat=True))
+        modalities = list(
+            Modality.objects.order_by("modality_name").values_list("modality_name", flat=True)
+        )
     except ProgrammingError:
         # empty database, most likely
-        pass
+        return hash_dict, uuid_dict, count_dict
+
+    data_version = get_data_version(datasets, modalities)
+    manifest_counts = None if rebuild else read_handle_manifest(data_version)
+    counts = {}
+    docs = []
+    names = [("dataset", uuid) for uuid in datasets]
+    names.extend(("modality", modality) for modality in modalities)
+    for kind, name in names:
+        if kind == "dataset":
+            query_set = Cell.objects.filter(dataset__uuid__in=[name]).distinct("cell_id")
+        else:
+            query_set = Cell.objects.filter(modality__modality_name__in=[name]).distinct("cell_id")
+        doc = make_handle_doc(query_set, "cell")
+        if manifest_counts is not None and (kind, name) in manifest_counts:
+            counts[kind, name] = manifest_counts[kind, name]
+        else:
+            counts[kind, name] = query_set.count()
+        doc["count"] = counts[kind, name]
+        docs.append(doc)
+
+        hash = doc["query_handle"]
+        hash_dict[hash] = name
+        uuid_dict[name] = hash
+        count_dict[hash] = counts[kind, name]
+
+    get_handle_store().put_many(docs)
+    if manifest_counts is None:
+        write_handle_manifest(data_version, counts)
+        print(f"{len(docs)} dataset and modality handles computed")
+    else:
+        print(f"{len(docs)} dataset and modality handles read from the manifest")
     return hash_dict, uuid_dict, count_dict
 
 
@@ -168,50 +240,74 @@ def attempt_to_open_file(file_path, key=None):
         return df
 
 
+def open_zarr_root():
+    try:
+        return zarr.open(fspath(PATH_TO_ZARR), mode="r")
+    except PathNotFoundError:
+        return zarr.open(fspath(PATH_TO_ZARR), mode="a")
+
+
+def register_tables():
+    """Registers the loaders of the reference tables, which are read when first used through
+    data_registry.get_table rather than here"""
+    register = data_registry.register
+    if settings.SKIP_LOADING_PVALUES:
+        register("rna_pvals", pd.DataFrame)
+        register("atac_pvals", pd.DataFrame)
+    else:
+        register(
+            "rna_pvals",
+            partial(attempt_to_open_file, PATH_TO_RNA_PVALS, "pval"),
+            [PATH_TO_RNA_PVALS],
+        )
+        register(
+            "atac_pvals", get_atac_pvals, [PATH_TO_ATAC_ORGAN_PVALS, PATH_TO_ATAC_CLUSTER_PVALS]
+        )
+
+    percentages_paths = {
+        "rna": PATH_TO_RNA_PERCENTAGES,
+        "atac": PATH_TO_ATAC_PERCENTAGES,
+        "codex": PATH_TO_CODEX_PERCENTAGES,
+    }
+    pvals_paths = {
+        "rna": PATH_TO_RNA_PVALS,
+        "atac": PATH_TO_ATAC_PVALS,
+        "codex": PATH_TO_CODEX_PVALS,
+    }
+    for modality, path in percentages_paths.items():
+        register(
+            f"{modality}_percentages", partial(attempt_to_open_file, path, "percentages"), [path]
+        )
+    for modality, path in pvals_paths.items():
+        register(f"{modality}_gene_df", partial(attempt_to_open_file, path, "gene"), [path])
+        register(f"{modality}_cell_df", partial(attempt_to_open_file, path, "cell"), [path])
+
+    register("zarr_root", open_zarr_root)
+
+
 class QueryAppConfig(AppConfig):
     name = "query_app"
 
     def ready(self):
-        global rna_pvals
-        global atac_pvals
-        global rna_percentages
-        global atac_percentages
-        global codex_percentages
-        global codex_cell_df
-        global rna_cell_df
-        global atac_cell_df
-        global codex_gene_df
-        global rna_gene_df
-        global atac_gene_df
         global hash_dict
         global uuid_dict
         global count_dict
-        global zarr_root
 
-        set_up_mongo()
+        register_tables()
+        if settings.PRELOAD_TABLES:
+            data_registry.preload()
+            # Left out of garbage collection, which would write to (and so copy) every page
+            # holding the preloaded objects in workers forked from this process
+            gc.freeze()
 
-        hash_dict, uuid_dict, count_dict = compute_dataset_hashes()
+        with timed_phase("set up handle store"):
+            set_up_handle_store()
 
-        print("Quant adatas read in")
-        if settings.SKIP_LOADING_PVALUES:
-            atac_pvals = pd.DataFrame()
-            rna_pvals = pd.DataFrame()
-        else:
-            rna_pvals = attempt_to_open_file(PATH_TO_RNA_PVALS, "pval")
-            atac_pvals = get_atac_pvals()
-        print("Pvals read in")
-        rna_percentages = attempt_to_open_file(PATH_TO_RNA_PERCENTAGES, "percentages")
-        atac_percentages = attempt_to_open_file(PATH_TO_ATAC_PERCENTAGES, "percentages")
-        codex_percentages = attempt_to_open_file(PATH_TO_CODEX_PERCENTAGES, "percentages")
-        print("Percentages read in")
-        rna_gene_df = attempt_to_open_file(PATH_TO_RNA_PVALS, "gene")
-        atac_gene_df = attempt_to_open_file(PATH_TO_ATAC_PVALS, "gene")
-        codex_gene_df = attempt_to_open_file(PATH_TO_CODEX_PVALS, "gene")
-        rna_cell_df = attempt_to_open_file(PATH_TO_RNA_PVALS, "cell")
-        atac_cell_df = attempt_to_open_file(PATH_TO_ATAC_PVALS, "cell")
-        codex_cell_df = attempt_to_open_file(PATH_TO_CODEX_PVALS, "cell")
-        print(rna_gene_df)
-        try:
-            zarr_root = zarr.open("/opt/data/zarr/example.zarr", mode="r")
-        except PathNotFoundError:
-            zarr_root = zarr.open("/opt/data/zarr/example.zarr", mode="a")
+        with timed_phase("compute dataset hashes"):
+            hash_dict, uuid_dict, count_dict = compute_dataset_hashes()
+
+        # With lazy-apps off this runs in the uwsgi master, whose database connections the
+        # workers it forks would otherwise share. Each worker opens its own on first use
+        connections.close_all()
+
+        print(json.dumps({"startup_phases": get_phase_timings()}))
@@ -0,0 +1,145 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .data_registry import get_table
+from .models import Cell
+
+cell_modalities = ["atac", "codex", "rna"]
+
+# Per modality, the Cell primary key of each row of the zarr arrays,
+# or -1 for rows without a Cell in the database
+position_pks_dict = {}
+# Per modality, the positions and primary keys of Cells whose cell ID is shared with
+# the Cell in position_pks_dict, usually empty
+duplicate_pks_dict = {}
+# Per modality, every primary key of a zarr row sorted, along with the position of each
+sorted_position_pks_dict = {}
+# Per modality, the row of the cell DataFrame holding each row of the zarr arrays
+position_rows_dict = {}
+position_pks_lock = threading.Lock()
+
+
+def get_cell_df(modality: str) -> pd.DataFrame:
+    return get_table(f"{modality}_cell_df")
+
+
+def build_position_pks(modality: str):
+    """str -> Tuple[np.ndarray, np.ndarray, np.ndarray]
+    Returns the lowest Cell primary key at each row position, along with the positions and
+    primary keys of any further Cells sharing a cell ID, which filters on cell_id also match"""
+    cell_df = get_cell_df(modality)
+    cell_pairs = Cell.objects.filter(modality__modality_name=modality).values_list("cell_id", "pk")
+    pk_df = pd.DataFrame.from_records(cell_pairs.iterator(), columns=["cell_id", "pk"])
+    pk_df = pk_df.sort_values("pk", kind="stable")
+    duplicated = pk_df["cell_id"].duplicated()
+    pk_series = pk_df[~duplicated].set_index("cell_id")["pk"]
+    pks = pk_series.reindex(cell_df["cell_id"].to_numpy()).fillna(-1).to_numpy(dtype=np.int64)
+    int_index = get_int_index(cell_df)
+    position_pks = np.full(int_index.max() + 1 if len(int_index) else 0, -1, dtype=np.int64)
+    position_pks[int_index] = pks
+    position_df = pd.DataFrame({"cell_id": cell_df["cell_id"].to_numpy(), "position": int_index})
+    duplicate_df = pk_df[duplicated].merge(position_df, on="cell_id")
+    duplicate_positions = duplicate_df["position"].to_numpy(dtype=np.int64)
+    duplicate_pks = duplicate_df["pk"].to_numpy(dtype=np.int64)
+    return position_pks, duplicate_positions, duplicate_pks
+
+
+def get_int_index(cell_df: pd.DataFrame) -> np.ndarray:
+    # The cell DataFrames are sorted by cell ID, int_index is the row of each cell in zarr
+    if "int_index" in cell_df.columns:
+        return cell_df["int_index"].to_numpy(dtype=np.int64)
+    return np.arange(len(cell_df))
+
+
+def get_position_pks(modality: str) -> np.ndarray:
+    """str -> np.ndarray
+    Returns the row position -> Cell primary key mapping of a modality, built on first use"""
+    if modality not in position_pks_dict:
+        with position_pks_lock:
+            if modality not in position_pks_dict:
+                position_pks, *duplicates = build_position_pks(modality)
+                for array in position_pks, *duplicates:
+                    array.setflags(write=False)
+                duplicate_pks_dict[modality] = tuple(duplicates)
+                position_pks_dict[modality] = position_pks
+    return position_pks_dict[modality]
+
+
+def get_duplicate_pks(modality: str):
+    """str -> Tuple[np.ndarray, np.ndarray]
+    Returns the positions and primary keys of the Cells not in get_position_pks
+    because another Cell of the modality has the same cell ID"""
+    get_position_pks(modality)
+    return duplicate_pks_dict[modality]
+
+
+def get_position_rows(modality: str) -> np.ndarray:
+    """str -> np.ndarray
+    Returns the row position -> cell DataFrame row mapping of a modality, built on first use"""
+    if modality not in position_rows_dict:
+        position_pks = get_position_pks(modality)
+        with position_pks_lock:
+            if modality not in position_rows_dict:
+                cell_df = get_cell_df(modality)
+                position_rows = np.full(len(position_pks), -1, dtype=np.int64)
+                position_rows[get_int_index(cell_df)] = np.arange(len(cell_df))
+                position_rows.setflags(write=False)
+                position_rows_dict[modality] = position_rows
+    return position_rows_dict[modality]
+
+
+def get_sorted_position_pks(modality: str):
+    if modality not in sorted_position_pks_dict:
+        position_pks = get_position_pks(modality)
+        with position_pks_lock:
+            if modality not in sorted_position_pks_dict:
+                duplicate_positions, duplicate_pks = get_duplicate_pks(modality)
+                all_pks = np.concatenate([position_pks, duplicate_pks])
+                all_positions = np.concatenate([np.arange(len(position_pks)), duplicate_positions])
+                order = np.argsort(all_pks, kind="stable")
+                sorted_pks = all_pks[order]
+                sorted_positions = all_positions[order]
+                sorted_pks.setflags(write=False)
+                sorted_positions.setflags(write=False)
+                sorted_position_pks_dict[modality] = sorted_pks, sorted_positions
+    return sorted_position_pks_dict[modality]
+
+
+def pks_to_positions(modality: str, pks: np.ndarray):
+    """str, np.ndarray -> Tuple[np.ndarray, np.ndarray]
+    Finds the row positions of the cells of a modality among a set of primary keys,
+    returns a mask of the keys that belong to the modality and their positions"""
+    sorted_pks, sorted_positions = get_sorted_position_pks(modality)
+    if len(sorted_pks) == 0:
+        return np.zeros(len(pks), dtype=bool), np.empty(0, dtype=np.int64)
+    indices = np.minimum(np.searchsorted(sorted_pks, pks), len(sorted_pks) - 1)
+    found = sorted_pks[indices] == pks
+    return found, sorted_positions[indices[found]]
+
+
+def read_quant_values(modality: str, var_id: str, positions: np.ndarray) -> np.ndarray:
+    """str, str, np.ndarray -> np.ndarray
+    Reads the values of a variable at a set of row positions, in the order given,
+    touching only the zarr chunks those positions fall in. Missing variables read as NaN"""
+    try:
+        array = get_table("zarr_root")[f"/{modality}/{var_id}"]
+    except KeyError:
+        return np.full(len(positions), np.nan)
+    values = np.empty(len(positions), dtype=float)
+    if len(positions) > 0:
+        order = np.argsort(positions, kind="stable")
+        values[order] = array.get_orthogonal_selection(positions[order])
+    return values
+
+
+def positions_to_pks(modality: str, positions: np.ndarray) -> np.ndarray:
+    position_pks = get_position_pks(modality)
+    # The last zarr rows can have no cell DataFrame row, e.g. cells without clusters,
+    # in which case position_pks stops short of them
+    pks = position_pks[positions[positions < len(position_pks)]]
+    duplicate_positions, duplicate_pks = get_duplicate_pks(modality)
+    if len(duplicate_pks):
+        pks = np.concatenate([pks, duplicate_pks[np.isin(duplicate_positions, positions)]])
+    return np.sort(pks[pks >= 0])
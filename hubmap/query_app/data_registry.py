@@ -0,0 +1,170 @@
+import os
+import threading
+from pathlib import Path
+
+import anndata
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from django.conf import settings
+from pyarrow import feather
+
+from .timing import timed_phase
+
+
+class DataRegistry:
+    """Reference tables by name, each loaded on first use instead of at startup.
+    A table registered with source paths is also written to DATA_CACHE_DIR the first time
+    it's read from its sources; DataFrames as uncompressed Feather and AnnData as Feather
+    obs/var with a .npy matrix, so that later loads memory-map the cache and processes
+    share its pages through the OS page cache instead of each parsing their own copy"""
+
+    def __init__(self):
+        self.loaders = {}
+        self.tables = {}
+        # Reentrant, a loader can itself get other tables
+        self.lock = threading.RLock()
+
+    def register(self, name, loader, source_paths=()):
+        """str, Callable[[], Any], Iterable[Path]"""
+        self.loaders[name] = loader, [Path(path) for path in source_paths]
+
+    def get(self, name):
+        try:
+            return self.tables[name]
+        except KeyError:
+            pass
+        with self.lock:
+            if name not in self.tables:
+                with timed_phase(f"load {name}"):
+                    self.tables[name] = self.load(name)
+        return self.tables[name]
+
+    def load(self, name):
+        loader, source_paths = self.loaders[name]
+        cache_path = get_cache_path(name) if source_paths else None
+        if cache_path is not None and is_fresh(cache_path, source_paths):
+            try:
+                return prepare_table(read_cache(cache_path))
+            except (OSError, ValueError, pa.ArrowException) as e:
+                print(f"Couldn't read {cache_path}: {e}")
+        table = loader()
+        # Tables from missing sources are empty placeholders, not worth caching
+        if cache_path is not None and all(path.exists() for path in source_paths):
+            try:
+                write_cache(table, cache_path)
+            except (OSError, ValueError, pa.ArrowException) as e:
+                print(f"Couldn't cache {name} in {cache_path}: {e}")
+        return prepare_table(table)
+
+    def preload(self):
+        """Loads every registered table, so that processes forked afterwards share them"""
+        for name in self.loaders:
+            self.get(name)
+
+    def loaded(self):
+        """-> List[str]"""
+        return sorted(self.tables)
+
+    def clear(self):
+        with self.lock:
+            self.tables.clear()
+
+
+def get_cache_path(name: str):
+    if settings.DATA_CACHE_DIR is None:
+        return None
+    return Path(settings.DATA_CACHE_DIR) / name
+
+
+def is_fresh(cache_path: Path, source_paths) -> bool:
+    try:
+        cache_mtime = (cache_path / "done").stat().st_mtime
+        return all(cache_mtime >= path.stat().st_mtime for path in source_paths)
+    except FileNotFoundError:
+        return False
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Stores string columns as categoricals, i.e. a NumPy array of codes and one object per
+    distinct string instead of one per row. Forked workers touching the reference counts of
+    per-row strings would otherwise copy every page holding them"""
+    for column in df.columns:
+        series = df[column]
+        if series.dtype == object and pd.api.types.infer_dtype(series, skipna=False) == "string":
+            df[column] = series.astype("category")
+    return df
+
+
+def prepare_table(table):
+    # Compacting only pays off for tables shared with workers forked after preloading,
+    # and changes the dtypes every other user of the frames sees
+    if settings.PRELOAD_TABLES and isinstance(table, pd.DataFrame):
+        return compact_frame(table)
+    return table
+
+
+def write_frame(df: pd.DataFrame, path: Path):
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    # Compressed Feather files can't be memory-mapped
+    feather.write_feather(table, path, compression="uncompressed")
+
+
+def read_frame(path: Path) -> pd.DataFrame:
+    table = feather.read_table(path, memory_map=True)
+    # Numeric columns without nulls stay views of the mapped file
+    df = table.to_pandas(split_blocks=True)
+    # List columns (cell clusters) come back as arrays, but are serialized as lists
+    for field in table.schema:
+        if pa.types.is_list(field.type) and field.name in df.columns:
+            df[field.name] = pd.Series(table.column(field.name).to_pylist(), index=df.index)
+    return df
+
+
+def write_cache(table, cache_path: Path):
+    if isinstance(table, anndata.AnnData) and not isinstance(table.X, np.ndarray):
+        # Sparse and empty matrices are read from their sources every time
+        return
+    if not isinstance(table, (pd.DataFrame, anndata.AnnData)):
+        return
+    # Several workers can fill the cache at once, each writes its own directory
+    # and the first rename wins
+    temp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    temp_path.mkdir(parents=True, exist_ok=True)
+    if isinstance(table, pd.DataFrame):
+        write_frame(table, temp_path / "frame.feather")
+    else:
+        write_frame(table.obs, temp_path / "obs.feather")
+        write_frame(table.var, temp_path / "var.feather")
+        np.save(temp_path / "X.npy", table.X)
+    (temp_path / "done").touch()
+    try:
+        if cache_path.exists():
+            for path in cache_path.iterdir():
+                path.unlink()
+            cache_path.rmdir()
+        temp_path.rename(cache_path)
+    except OSError:
+        for path in temp_path.iterdir():
+            path.unlink()
+        temp_path.rmdir()
+
+
+def read_cache(cache_path: Path):
+    if (cache_path / "frame.feather").exists():
+        return read_frame(cache_path / "frame.feather")
+    return anndata.AnnData(
+        np.load(cache_path / "X.npy", mmap_mode="r"),
+        obs=read_frame(cache_path / "obs.feather"),
+        var=read_frame(cache_path / "var.feather"),
+    )
+
+
+data_registry = DataRegistry()
+
+
+def get_table(name: str):
+    """str -> Any
+    Returns one of the reference tables registered in QueryAppConfig.ready, loading it on first
+    use, e.g. get_table("rna_cell_df")"""
+    return data_registry.get(name)
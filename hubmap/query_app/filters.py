@@ -1,30 +1,23 @@
 from functools import reduce
 from operator import and_, eq, ge, gt, le, lt, ne, or_
+from time import time
 from typing import Dict, List
 
+import numpy as np
+from django.conf import settings
 from django.core.cache import cache
 from django.db.models import Case, Count, IntegerField, Q, Sum, When
+from django.db.models.expressions import RawSQL
 
-from .apps import (
-    atac_cell_df,
-    atac_gene_df,
-    atac_percentages,
-    atac_pvals,
-    codex_cell_df,
-    codex_gene_df,
-    codex_percentages,
-    rna_cell_df,
-    rna_gene_df,
-    rna_percentages,
-    rna_pvals,
-    zarr_root,
-)
+from .cell_index import positions_to_pks
+from .data_registry import get_table
+from .handle_store import LRUCache
 from .models import Cell, Cluster, Dataset, Modality, Organ
 from .utils import unpickle_query_set
 from .validation import process_query_parameters, split_at_comparator
+from .zarr_groups import SORTED_GROUP
 
 operators_dict = {">": gt, ">=": ge, "<": lt, "<=": le, "==": eq, "!=": ne}
-modalities_to_pvals = {"rna": rna_pvals, "atac": atac_pvals}
 
 
 def get_precomputed_datasets(modality, min_cell_percentage, input_set):
@@ -32,11 +25,11 @@ def get_precomputed_datasets(modality, min_cell_percentage, input_set):
         return None
 
     if modality == "rna":
-        df = rna_percentages
+        df = get_table("rna_percentages")
     elif modality == "atac":
-        df = atac_percentages
+        df = get_table("atac_percentages")
     elif modality == "codex":
-        df = codex_percentages
+        df = get_table("codex_percentages")
 
     print(input_set)
     input_set_split = split_at_comparator(input_set[0])
@@ -82,18 +75,172 @@ def combine_qs(qs: List[Q], logical_operator: str) -> Q:
         return reduce(and_, qs)
 
 
-def process_single_condition(
-    split_condition: List[str], input_type: str, genomic_modality=None
-) -> Q:
-    """List[str], str -> Q
-    Finds the keyword args for a quantitative query based on the results of
-    calling split_at_comparator() on a string representation of that condition"""
+def search_sorted_values(index, value: float, side: str) -> int:
+    """Binary search over a sorted value index without reading all of it:
+    the chunk fences locate the one chunk of values that needs to be read"""
+    values = index["values"]
+    chunk_length = values.chunks[0]
+    chunk = max(int(np.searchsorted(index["fences"][:], value, side=side)) - 1, 0)
+    start = chunk * chunk_length
+    chunk_values = values[start : start + chunk_length]
+    return start + int(np.searchsorted(chunk_values, value, side=side))
+
 
-    cell_dfs_dict = {"atac": atac_cell_df, "codex": codex_cell_df, "rna": rna_cell_df}
+def get_indexed_positions(modality: str, var_id: str, comparator: str, value: float):
+    """str, str, str, float -> Optional[np.ndarray]
+    Evaluates a quantitative condition with the sorted value index built by
+    build_value_index.py, or returns None if there is no index for this variable"""
+    try:
+        index = get_table("zarr_root")[f"/{SORTED_GROUP}/{modality}/{var_id}"]
+    except KeyError:
+        return None
 
-    value = float(split_condition[2].strip())
+    positions = index["positions"]
+    valid_count = index.attrs["valid_count"]
+
+    if comparator in {">", ">=", "<", "<=", "=="}:
+        start = 0
+        stop = valid_count
+        if comparator in {">=", "=="}:
+            start = search_sorted_values(index, value, "left")
+        if comparator == ">":
+            start = search_sorted_values(index, value, "right")
+        if comparator in {"<=", "=="}:
+            stop = search_sorted_values(index, value, "right")
+        if comparator == "<":
+            stop = search_sorted_values(index, value, "left")
+        matches = positions[start:stop]
+    elif comparator == "!=":
+        # NaN != value holds, so the trailing NaN values are included here
+        start = search_sorted_values(index, value, "left")
+        stop = search_sorted_values(index, value, "right")
+        matches = np.concatenate([positions[:start], positions[stop:]])
+    else:
+        raise ValueError(f"{comparator} not in {sorted(operators_dict)}")
+
+    return np.sort(matches)
+
+
+def get_quant_array(modality: str, var_id: str):
+    try:
+        return get_table("zarr_root")[f"/{modality}/{var_id}"]
+    except KeyError as e:
+        raise ValueError(f"{var_id} not present in {modality} index")
 
-    var_id = split_condition[0].strip()
+
+def scan_conditions(conditions: List, logical_operator: str) -> np.ndarray:
+    """List[Tuple[zarr.Array, Callable, float]], str -> np.ndarray
+    Evaluates several quantitative conditions in a single pass over their zarr arrays:
+    the boolean masks of each chunk are combined before moving on to the next chunk"""
+    combine_masks = np.logical_and if logical_operator == "and" else np.logical_or
+    length = conditions[0][0].shape[0]
+    chunk_length = conditions[0][0].chunks[0]
+    positions = [np.empty(0, dtype=np.int64)]
+    for start in range(0, length, chunk_length):
+        masks = [
+            operator(array[start : start + chunk_length], value)
+            for array, operator, value in conditions
+        ]
+        positions.append(np.flatnonzero(reduce(combine_masks, masks)) + start)
+    return np.concatenate(positions)
+
+
+def filter_positions(positions: np.ndarray, conditions: List) -> np.ndarray:
+    """Keeps the positions that satisfy every condition, reading only the chunks they fall in"""
+    for array, operator, value in conditions:
+        if len(positions) == 0:
+            break
+        positions = positions[operator(array.get_orthogonal_selection(positions), value)]
+    return positions
+
+
+def get_conditions_positions(
+    modality: str, split_conditions: List[List[str]], logical_operator: str
+) -> np.ndarray:
+    """str, List[List[str]], str -> np.ndarray
+    Evaluates a set of quantitative conditions combined with a logical operator,
+    returning the sorted row positions of the matching cells"""
+    indexed_positions = []
+    scanned_conditions = []
+    for var_id, comparator, value in split_conditions:
+        if comparator not in operators_dict:
+            raise ValueError(f"{comparator} not in {sorted(operators_dict)}")
+        array = get_quant_array(modality, var_id)
+        positions = get_indexed_positions(modality, var_id, comparator, float(value))
+        if positions is None:
+            scanned_conditions.append((array, operators_dict[comparator], float(value)))
+        else:
+            indexed_positions.append(positions)
+
+    if logical_operator == "and":
+        if len(indexed_positions) > 0:
+            positions = reduce(
+                lambda a, b: np.intersect1d(a, b, assume_unique=True), indexed_positions
+            )
+            return filter_positions(positions, scanned_conditions)
+        return scan_conditions(scanned_conditions, logical_operator)
+
+    if len(scanned_conditions) > 0:
+        indexed_positions.append(scan_conditions(scanned_conditions, logical_operator))
+    return reduce(np.union1d, indexed_positions)
+
+
+condition_pks_cache = LRUCache(
+    settings.CONDITION_PKS_CACHE_MAX_ENTRIES, settings.CONDITION_PKS_CACHE_MAX_BYTES
+)
+
+
+def get_condition_pks(modality: str, split_conditions: List[List[str]], logical_operator: str):
+    """str, List[List[str]], str -> np.ndarray
+    Primary keys of the cells meeting a set of quantitative conditions, kept for a while
+    since a query-only handle compiles its query again on every evaluation"""
+    key = modality, str(split_conditions), logical_operator
+    pks = condition_pks_cache.get(key)
+    if pks is None:
+        positions = get_conditions_positions(modality, split_conditions, logical_operator)
+        pks = positions_to_pks(modality, positions)
+        pks.setflags(write=False)
+        condition_pks_cache.put(
+            key, pks, expires_at=time() + settings.TOKEN_EXPIRATION_TIME, size=pks.nbytes
+        )
+    return pks
+
+
+class ConditionPks(RawSQL):
+    """Subquery of the primary keys of the cells meeting a set of quantitative conditions,
+    sent to Postgres as one integer array parameter. The keys are found when the query is
+    compiled, so that pickled queries (and so handles) hold the conditions rather than
+    every matching key"""
+
+    # Shared and left out of pickles: a Field made for each instance would carry its own
+    # creation counter, and equal queries would then hash to different handles
+    output_field = IntegerField()
+
+    def __init__(self, modality: str, split_conditions: List[List[str]], logical_operator: str):
+        super().__init__("SELECT UNNEST(%s::integer[])", (), output_field=self.output_field)
+        self.modality = modality
+        self.split_conditions = split_conditions
+        self.logical_operator = logical_operator
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop("output_field", None)
+        return state
+
+    def as_sql(self, compiler, connection):
+        pks = get_condition_pks(self.modality, self.split_conditions, self.logical_operator)
+        return f"({self.sql})", ([int(pk) for pk in pks],)
+
+
+def process_conditions(
+    split_conditions: List[List[str]],
+    input_type: str,
+    genomic_modality=None,
+    logical_operator: str = "or",
+) -> Q:
+    """List[List[str]], str -> Q
+    Finds the filter for a quantitative query based on the results of
+    calling split_at_comparator() on string representations of its conditions"""
 
     if input_type == "protein":
         modality = "codex"
@@ -102,17 +249,14 @@ def process_single_condition(
     elif genomic_modality == "atac":
         modality = "atac"
 
-    cell_df = cell_dfs_dict[modality]
-
-    try:
-        operator = operators_dict[split_condition[1].strip()]
-        num_array = zarr_root[f"/{modality}/{var_id}"][:]
-        bool_array = operator(num_array, value)
-        cell_ids = cell_df[bool_array].cell_id.to_list()
-        return Q(cell_id__in=cell_ids)
+    # Checked here rather than only when the query is first compiled
+    for var_id, comparator, value in split_conditions:
+        if comparator not in operators_dict:
+            raise ValueError(f"{comparator} not in {sorted(operators_dict)}")
+        get_quant_array(modality, var_id)
+        float(value)
 
-    except KeyError as e:
-        raise ValueError(f"{var_id} not present in {modality} index")
+    return Q(pk__in=ConditionPks(modality, split_conditions, logical_operator))
 
 
 def get_gene_filter(query_params: Dict) -> Q:
@@ -135,9 +279,9 @@ def get_gene_filter(query_params: Dict) -> Q:
     elif input_type == "modality":
         genes_list = []
         if "rna" in input_set:
-            genes_list.extend(list(rna_gene_df.index))
+            genes_list.extend(list(get_table("rna_gene_df").index))
         if "atac" in input_set:
-            genes_list.extend(list(atac_gene_df.index))
+            genes_list.extend(list(get_table("atac_gene_df").index))
         return Q(gene_symbol__in=genes_list)
 
     genomic_modality = query_params["genomic_modality"]
@@ -145,13 +289,13 @@ def get_gene_filter(query_params: Dict) -> Q:
     if input_type in groupings_dict:
 
         if genomic_modality == "rna":
-            df = rna_pvals
+            df = get_table("rna_pvals")
             df = df[df["grouping_name"].isin(input_set)]
             df = df[df["value"] <= p_value]
             gene_symbols = list(df["gene_id"].unique())
 
         elif genomic_modality == "atac":
-            atac_pvals = modalities_to_pvals["atac"]
+            atac_pvals = get_table("atac_pvals")
             atac_pvals = atac_pvals[atac_pvals.obs.grouping_type == input_type]
             bool_masks = [atac_pvals[[var], :].X <= p_value for var in input_set]
             bool_mask = reduce(or_, bool_masks)
@@ -192,15 +336,11 @@ def get_cell_filter(query_params: Dict) -> Q:
             for item in input_set
         ]
 
-        split_conditions = [[item.strip() for condition in split_conditions for item in condition]]
+        split_conditions = [[item.strip() for item in condition] for condition in split_conditions]
 
-        qs = [
-            process_single_condition(condition, input_type, genomic_modality)
-            for condition in split_conditions
-        ]
-        q = combine_qs(qs, "or")
-
-        return q
+        return process_conditions(
+            split_conditions, input_type, genomic_modality, query_params["logical_operator"]
+        )
 
     elif input_type in groupings_dict:
 
@@ -248,12 +388,12 @@ def get_organ_filter(query_params: Dict) -> Q:
         p_value = query_params["p_value"]
 
         if genomic_modality == "rna":
-            df = rna_pvals
+            df = get_table("rna_pvals")
             df = df[df["gene_id"].isin(input_set)]
             df = df[df["value"] <= p_value]
             grouping_names = list(df["grouping_name"].unique())
         elif genomic_modality == "atac":
-            atac_pvals = modalities_to_pvals["atac"]
+            atac_pvals = get_table("atac_pvals")
             organ_pvals = atac_pvals[atac_pvals.obs.grouping_type == "organ"]
             bool_masks = [organ_pvals[:, [var]].X <= p_value for var in input_set]
             bool_mask = reduce(or_, bool_masks)
@@ -310,13 +450,13 @@ def get_cluster_filter(query_params: dict):
         p_value = query_params["p_value"]
 
         if genomic_modality == "rna":
-            df = rna_pvals
+            df = get_table("rna_pvals")
             df = df[df["gene_id"].isin(input_set)]
             df = df[df["value"] <= p_value]
             grouping_names = list(df["grouping_name"].unique())
 
         elif genomic_modality == "atac":
-            atac_pvals = modalities_to_pvals["atac"]
+            atac_pvals = get_table("atac_pvals")
             cluster_pvals = atac_pvals[atac_pvals.obs.grouping_type == "cluster"]
             bool_masks = [cluster_pvals[:, [var]].X <= p_value for var in input_set]
             bool_mask = reduce(or_, bool_masks)
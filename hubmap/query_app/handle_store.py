@@ -0,0 +1,407 @@
+import os
+import pickle
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from os import fspath
+from time import time
+
+import redis
+from django.conf import settings
+from django.utils.module_loading import import_string
+from pymongo import MongoClient, ReplaceOne, monitoring
+from pymongo.errors import OperationFailure
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Keeps running totals of connection pool events for the handle store client"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {
+                "connections_created": 0,
+                "connections_closed": 0,
+                "checkouts": 0,
+                "checkins": 0,
+                "checkout_failures": 0,
+                "pools_cleared": 0,
+            }
+
+    def increment(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats["connections_open"] = stats["connections_created"] - stats["connections_closed"]
+        stats["connections_in_use"] = stats["checkouts"] - stats["checkins"]
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.increment("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.increment("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.increment("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.increment("checkout_failures")
+
+    def connection_checked_out(self, event):
+        self.increment("checkouts")
+
+    def connection_checked_in(self, event):
+        self.increment("checkins")
+
+
+class LRUCache:
+    """Bounded, thread-safe least-recently-used cache whose entries also expire.
+    Entries can be given a size, in which case the total size is bounded as well"""
+
+    def __init__(self, max_entries, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None and item[1] <= time():
+                self.pop(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, expires_at, size=0):
+        if self.max_entries <= 0 or expires_at <= time():
+            return
+        with self.lock:
+            if key in self.entries:
+                self.pop(key)
+            self.entries[key] = (value, expires_at, size)
+            self.total_size += size
+            while len(self.entries) > self.max_entries or (
+                self.max_size is not None and self.total_size > self.max_size and self.entries
+            ):
+                self.pop(next(iter(self.entries)))
+
+    def pop(self, key):
+        value, expires_at, size = self.entries.pop(key)
+        self.total_size -= size
+
+    def get_expiry(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            return None if item is None else item[1]
+
+    def __contains__(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            return item is not None and item[1] > time()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.total_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class HandleStore(ABC):
+    """Interface of the backends that persist query handle documents.
+    A document is a dict with at least query_handle, query_pickle, set_type and created_at,
+    and expires TOKEN_EXPIRATION_TIME seconds after its created_at"""
+
+    name = None
+
+    def __init__(self, options):
+        self.options = options
+
+    def set_up(self):
+        pass
+
+    @abstractmethod
+    def get(self, query_handle):
+        """str -> Optional[dict]"""
+
+    @abstractmethod
+    def put(self, doc):
+        """Upserts a handle document: writing an existing handle again replaces its document,
+        fields missing from the new one included, and refreshes its expiry"""
+
+    def put_many(self, docs):
+        """Upserts several handle documents, in one round trip for backends that support it"""
+        for doc in docs:
+            self.put(doc)
+
+    @abstractmethod
+    def update(self, query_handle, fields):
+        """Sets fields of an existing document without changing its expiry"""
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+class MongoHandleStore(HandleStore):
+    name = "mongo"
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.pool_stats_listener = PoolStatsListener()
+        self.client_lock = threading.Lock()
+        self.client = None
+        self.client_pid = None
+
+    def get_client(self):
+        """-> MongoClient
+        Returns the process-wide Mongo client, creating it on first use.
+        A client inherited across fork() is never reused: uwsgi workers each get their own pool"""
+        pid = os.getpid()
+        if self.client is None or self.client_pid != pid:
+            with self.client_lock:
+                if self.client is None or self.client_pid != pid:
+                    self.pool_stats_listener.reset()
+                    self.client = MongoClient(
+                        settings.MONGO_HOST_AND_PORT,
+                        maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                        minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+                        maxIdleTimeMS=settings.MONGO_MAX_IDLE_TIME_MS,
+                        serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                        event_listeners=[self.pool_stats_listener],
+                        connect=False,
+                    )
+                    self.client_pid = pid
+        return self.client
+
+    def get_collection(self):
+        client = self.get_client()
+        return client[settings.MONGO_DB_NAME][settings.MONGO_COLLECTION_NAME]
+
+    def set_up(self):
+        collection = self.get_collection()
+        collection.create_index("created_at", expireAfterSeconds=settings.TOKEN_EXPIRATION_TIME)
+        try:
+            collection.create_index("query_handle", unique=True)
+        except OperationFailure:
+            # Stores written before handles were upserted can hold duplicates
+            self.remove_duplicate_handles(collection)
+            collection.create_index("query_handle", unique=True)
+
+    def remove_duplicate_handles(self, collection):
+        pipeline = [
+            {"$group": {"_id": "$query_handle", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]
+        for group in collection.aggregate(pipeline, allowDiskUse=True):
+            collection.delete_many({"_id": {"$in": group["ids"][1:]}})
+
+    def get(self, query_handle):
+        return self.get_collection().find_one({"query_handle": query_handle})
+
+    def put(self, doc):
+        collection = self.get_collection()
+        collection.replace_one({"query_handle": doc["query_handle"]}, doc, upsert=True)
+
+    def put_many(self, docs):
+        requests = [
+            ReplaceOne({"query_handle": doc["query_handle"]}, doc, upsert=True) for doc in docs
+        ]
+        if requests:
+            self.get_collection().bulk_write(requests, ordered=False)
+
+    def update(self, query_handle, fields):
+        collection = self.get_collection()
+        collection.update_one({"query_handle": query_handle}, {"$set": fields})
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(self.pool_stats_listener.stats())
+        stats["max_pool_size"] = settings.MONGO_MAX_POOL_SIZE
+        stats["pid"] = self.client_pid
+        return stats
+
+
+class RedisHandleStore(HandleStore):
+    """Keeps each handle document pickled under its own key, with the handle lifetime as TTL.
+    OPTIONS: LOCATION, a redis:// URL, and KEY_PREFIX"""
+
+    name = "redis"
+
+    def __init__(self, options):
+        super().__init__(options)
+        # redis-py connection pools detect fork() themselves
+        self.client = redis.Redis.from_url(options["LOCATION"])
+        self.key_prefix = options.get("KEY_PREFIX", "query_handle:")
+
+    def get(self, query_handle):
+        value = self.client.get(self.key_prefix + query_handle)
+        return None if value is None else pickle.loads(value)
+
+    def put(self, doc):
+        self.client.set(
+            self.key_prefix + doc["query_handle"],
+            pickle.dumps(doc),
+            ex=settings.TOKEN_EXPIRATION_TIME,
+        )
+
+    def update(self, query_handle, fields):
+        key = self.key_prefix + query_handle
+
+        def update_doc(pipe):
+            value = pipe.get(key)
+            if value is None:
+                return
+            doc = pickle.loads(value)
+            doc.update(fields)
+            pipe.multi()
+            pipe.set(key, pickle.dumps(doc), keepttl=True)
+
+        # Watches the key, and retries if another client writes it between the read and the set
+        self.client.transaction(update_doc, key)
+
+    def stats(self):
+        stats = super().stats()
+        pool = self.client.connection_pool
+        stats["max_pool_size"] = pool.max_connections
+        stats["pid"] = pool.pid
+        return stats
+
+
+class SQLiteHandleStore(HandleStore):
+    """Embedded store for single-node deployments and tests, without a network round-trip.
+    OPTIONS: LOCATION, the path of the database file"""
+
+    name = "sqlite"
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.location = fspath(options["LOCATION"])
+        self.local = threading.local()
+        self.writes = 0
+
+    def get_connection(self):
+        # sqlite3 connections can be shared neither across threads nor across fork()
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            connection = sqlite3.connect(self.location, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS handles "
+                "(query_handle TEXT PRIMARY KEY, created_at REAL, doc BLOB)"
+            )
+            self.local.connection = connection
+            self.local.pid = pid
+        return self.local.connection
+
+    def set_up(self):
+        connection = self.get_connection()
+        with connection:
+            connection.execute(
+                "DELETE FROM handles WHERE created_at < ?",
+                (time() - settings.TOKEN_EXPIRATION_TIME,),
+            )
+
+    def get(self, query_handle):
+        row = (
+            self.get_connection()
+            .execute(
+                "SELECT doc FROM handles WHERE query_handle = ? AND created_at >= ?",
+                (query_handle, time() - settings.TOKEN_EXPIRATION_TIME),
+            )
+            .fetchone()
+        )
+        return None if row is None else pickle.loads(row[0])
+
+    def put(self, doc):
+        connection = self.get_connection()
+        with connection:
+            self.write(connection, doc, time())
+        self.writes += 1
+        # Expired rows are cleared out every so often instead of on every write
+        if self.writes % 1000 == 0:
+            self.set_up()
+
+    def update(self, query_handle, fields):
+        connection = self.get_connection()
+        with connection:
+            # Takes the write lock before reading, so that concurrent updates of a document
+            # can't overwrite each other's fields
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT doc, created_at FROM handles WHERE query_handle = ?", (query_handle,)
+            ).fetchone()
+            if row is None:
+                return
+            doc = pickle.loads(row[0])
+            doc.update(fields)
+            self.write(connection, doc, row[1])
+
+    def write(self, connection, doc, created_at):
+        connection.execute(
+            "INSERT OR REPLACE INTO handles (query_handle, created_at, doc) VALUES (?, ?, ?)",
+            (doc["query_handle"], created_at, pickle.dumps(doc)),
+        )
+
+    def stats(self):
+        stats = super().stats()
+        stats["location"] = self.location
+        return stats
+
+
+handle_store_lock = threading.Lock()
+handle_store = None
+
+
+def get_handle_store():
+    """-> HandleStore
+    Returns the process-wide handle store, built from the HANDLE_STORE setting on first use"""
+    global handle_store
+
+    if handle_store is None:
+        with handle_store_lock:
+            if handle_store is None:
+                options = dict(settings.HANDLE_STORE)
+                backend = import_string(options.pop("BACKEND"))
+                handle_store = backend(options)
+    return handle_store
+
+
+handle_cache = LRUCache(settings.HANDLE_CACHE_MAX_ENTRIES, settings.HANDLE_CACHE_MAX_BYTES)
@@ -0,0 +1,66 @@
+import json
+from io import BytesIO
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def iter_ndjson(batches):
+    """Iterable[List[dict]] -> Iterator[str]
+    Encodes batches of records as newline-delimited JSON, one chunk of lines per batch"""
+    for batch in batches:
+        yield "".join(json.dumps(record, cls=JSONEncoder) + "\n" for record in batch)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Newline-delimited JSON, one record per line. Evaluations requested in this format
+    are streamed batch by batch by the views rather than rendered here"""
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        records = data if isinstance(data, list) else [data]
+        return "".join(iter_ndjson([records])).encode(self.charset)
+
+
+def frame_to_table(data) -> pa.Table:
+    """pd.DataFrame or List[dict] -> pa.Table"""
+    if not isinstance(data, pd.DataFrame):
+        data = pd.DataFrame.from_records(data if isinstance(data, list) else [data])
+    # Plain string columns rather than dictionary-encoded ones for categoricals
+    categorical_columns = data.select_dtypes("category").columns
+    data = data.astype({column: object for column in categorical_columns})
+    return pa.Table.from_pandas(data, preserve_index=False)
+
+
+class ArrowRenderer(BaseRenderer):
+    """Apache Arrow IPC stream, one column per field and per gene or protein value"""
+
+    media_type = "application/vnd.apache.arrow.stream"
+    format = "arrow"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        table = frame_to_table(data)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+
+class ParquetRenderer(BaseRenderer):
+    media_type = "application/vnd.apache.parquet"
+    format = "parquet"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        sink = BytesIO()
+        pq.write_table(frame_to_table(data), sink)
+        return sink.getvalue()
@@ -1,6 +1,6 @@
 import json
 from time import perf_counter
-from typing import List
+from typing import Dict, List
 
 import anndata
 import numpy as np
@@ -8,17 +8,13 @@ import pandas as pd
 from django.db.models import Case, IntegerField, Sum, When
 from rest_framework import serializers
 
-from .apps import (
-    atac_cell_df,
-    atac_percentages,
-    atac_pvals,
-    codex_cell_df,
-    codex_percentages,
-    rna_cell_df,
-    rna_percentages,
-    rna_pvals,
-    zarr_root,
+from .cell_index import (
+    cell_modalities,
+    get_cell_df,
+    pks_to_positions,
+    read_quant_values,
 )
+from .data_registry import get_table
 from .filters import get_cells_list, split_at_comparator
 from .models import Cell, CellType, Cluster, Dataset, Gene, Modality, Organ, Protein
 
@@ -56,15 +52,36 @@ def infer_values_type(values: List) -> str:
 
 
 def get_quant_value(cell_id, gene_symbol, modality):
-    cell_dfs_dict = {"atac": atac_cell_df, "codex": codex_cell_df, "rna": rna_cell_df}
-    cell_df = cell_dfs_dict[modality]
+    cell_df = get_cell_df(modality)
     array_index = cell_df.loc[(cell_id,), "int_index"].iloc[0]
     # array = zarr_root[f"/{modality}/{gene_symbol}"][:]
-    val = zarr_root[f"/{modality}/{gene_symbol}"][array_index]
+    val = get_table("zarr_root")[f"/{modality}/{gene_symbol}"][array_index]
 
     return val
 
 
+def get_quant_values(cell_pks, var_ids: List[str]) -> Dict:
+    """Iterable[int], List[str] -> Dict[int, Dict[str, float]]
+    Looks up the values of several genes or proteins for a page of cells at once,
+    with one zarr selection per modality and variable instead of one read per cell and variable"""
+    pks = np.asarray(cell_pks, dtype=np.int64)
+    values_matrix = np.full((len(pks), len(var_ids)), np.nan)
+    for modality in cell_modalities:
+        found, positions = pks_to_positions(modality, pks)
+        if len(positions) == 0:
+            continue
+        for j, var_id in enumerate(var_ids):
+            values_matrix[found, j] = read_quant_values(modality, var_id, positions)
+
+    return {
+        pk: {
+            var_id: None if np.isnan(value) else float(value)
+            for var_id, value in zip(var_ids, values_row)
+        }
+        for pk, values_row in zip(pks.tolist(), values_matrix)
+    }
+
+
 def get_precomputed_percentage(uuid, values_type, include_values):
     time_one = perf_counter()
     modality = (
@@ -74,11 +91,11 @@ def get_precomputed_percentage(uuid, values_type, include_values):
         .modality.modality_name
     )
     if modality == "rna":
-        df = rna_percentages
+        df = get_table("rna_percentages")
     elif modality == "atac":
-        df = atac_percentages
+        df = get_table("atac_percentages")
     elif modality == "codex":
-        df = codex_percentages
+        df = get_table("codex_percentages")
 
     if isinstance(include_values, list):
         set_split = split_at_comparator(include_values[0])
@@ -164,8 +181,8 @@ def get_atac_pval(pval_adata: anndata.AnnData, identifier: str, set_type: str, v
 
 def get_p_values(identifier: str, set_type: str, var_id: str, var_type, statistic="mean"):
 
-    rna_value = get_rna_pval(rna_pvals, identifier, set_type, var_id)
-    atac_value = get_atac_pval(atac_pvals, identifier, set_type, var_id)
+    rna_value = get_rna_pval(get_table("rna_pvals"), identifier, set_type, var_id)
+    atac_value = get_atac_pval(get_table("atac_pvals"), identifier, set_type, var_id)
 
     if rna_value is not None and atac_value is not None:
         return min(rna_value, atac_value)
@@ -216,7 +233,8 @@ class CellSerializer(serializers.ModelSerializer):
         ]
 
     def get_clusters(self, obj):
-        clusters_list = list(obj.clusters.all().values_list("grouping_name", flat=True))
+        # Iterating over all() rather than values_list() uses prefetched clusters
+        clusters_list = [cluster.grouping_name for cluster in obj.clusters.all()]
         if obj.cell_type is not None and "unknown" not in obj.cell_type.grouping_name:
             clusters_list.append(obj.cell_type.grouping_name)
         return clusters_list
@@ -272,6 +290,8 @@ class CellAndValuesSerializer(serializers.ModelSerializer):
         ]
 
     def get_values(self, obj):
+        if "values" in self.context:
+            return self.context["values"][obj.pk]
         request = self.context["request"]
         var_ids = request.POST.getlist("values_included")
         values_dict = {
@@ -281,7 +301,8 @@ class CellAndValuesSerializer(serializers.ModelSerializer):
         return values_dict
 
     def get_clusters(self, obj):
-        clusters_list = list(obj.clusters.all().values_list("grouping_name", flat=True))
+        # Iterating over all() rather than values_list() uses prefetched clusters
+        clusters_list = [cluster.grouping_name for cluster in obj.clusters.all()]
         if obj.cell_type is not None and "unknown" not in obj.cell_type.grouping_name:
             clusters_list.append(obj.cell_type.grouping_name)
         return clusters_list
@@ -1,21 +1,26 @@
 import json
-from time import perf_counter
+from functools import partial
+from time import perf_counter, time
 from typing import List
 
 import numpy as np
 import pandas as pd
+from django.conf import settings
 from django.db.models import Case, IntegerField, Q, Sum, When
 
-from query_app.apps import (
-    atac_cell_df,
-    codex_cell_df,
-    hash_dict,
-    rna_cell_df,
-    zarr_root,
-)
+from query_app.apps import count_dict, hash_dict
 
+from .cell_index import (
+    cell_modalities,
+    get_cell_df,
+    get_position_rows,
+    pks_to_positions,
+    read_quant_values,
+)
+from .data_registry import get_table
 from .filters import get_cells_list, split_at_comparator
-from .models import Cell, Cluster, Dataset, Gene, Organ, Protein
+from .handle_store import LRUCache
+from .models import Cell, CellType, Cluster, Dataset, Gene, Organ, Protein
 from .serializers import (
     CellAndValuesSerializer,
     CellSerializer,
@@ -30,11 +35,17 @@ from .serializers import (
     OrganSerializer,
     ProteinSerializer,
     get_quant_value,
+    get_quant_values,
 )
 from .utils import (
+    decode_cursor,
+    encode_cursor,
+    get_cell_pks,
     get_response_from_query_handle,
     get_response_with_count_from_query_handle,
     infer_values_type,
+    materialize_cell_pks,
+    save_handle_cell_pks,
     split_at_comparator,
     unpickle_query_set,
 )
@@ -47,7 +58,7 @@ from .validation import (
 )
 
 
-def copy_pagination_format(results_json: str) -> str:
+def copy_pagination_format(results_json: str, next_cursor=None) -> str:
     # We save time by bypassing Postgres and the Django ORM, including serializers
     # But we want to return a response in the same format as those paginated responses
     # So this function inserts the string we get from serializing a Pandas dataframe
@@ -55,7 +66,7 @@ def copy_pagination_format(results_json: str) -> str:
 
     response_dict = {}
     response_dict["count"] = 1
-    response_dict["next"] = None
+    response_dict["next"] = next_cursor
     response_dict["previous"] = None
     response_dict["results"] = []
     response_json = json.dumps(response_dict)
@@ -74,9 +85,9 @@ def annotate_list_with_values(dict_list, include_values, modality):
     return dict_list
 
 
-def get_dataset_cells(uuid, include_values, offset, limit):
-    print(f"Key found")
-
+def get_dataset_frame(uuid):
+    """str -> Tuple[str, pd.DataFrame]
+    The modality of a dataset, and the rows of its cells in that modality's cell DataFrame"""
     modality = (
         Dataset.objects.filter(uuid=uuid)
         .exclude(modality__isnull=True)
@@ -84,38 +95,45 @@ def get_dataset_cells(uuid, include_values, offset, limit):
         .modality.modality_name
     )
 
-    if modality == "rna":
-        cell_df = rna_cell_df
-
-    elif modality == "atac":
-        cell_df = atac_cell_df
-
-    elif modality == "codex":
-        cell_df = codex_cell_df
-
-    if len(include_values) > 0 and modality in {"atac", "rna"}:
-        validate_gene_modality(include_values[0], modality)
+    cell_df = get_cell_df(modality)
 
     #    cell_df = cell_df.loc[(uuid)]
     cell_df = cell_df[cell_df.dataset == uuid]
 
     keep_columns = ["cell_id", "modality", "dataset", "organ", "cell_type", "clusters"]
-    cell_df = cell_df[keep_columns]
+    return modality, cell_df[keep_columns]
+
+
+def get_dataset_cells(uuid, include_values, offset, limit, next_cursor=None, dataset_frames=None):
+    """dataset_frames, if given, keeps the result of get_dataset_frame for each dataset,
+    e.g. across the batches of one stream, instead of filtering the whole cell DataFrame
+    for every page"""
+    print(f"Key found")
+
+    if dataset_frames is None:
+        dataset_frames = {}
+    if uuid not in dataset_frames:
+        dataset_frames[uuid] = get_dataset_frame(uuid)
+    modality, cell_df = dataset_frames[uuid]
+
+    if len(include_values) > 0 and modality in {"atac", "rna"}:
+        validate_gene_modality(include_values[0], modality)
 
     if len(include_values) > 0:
         print("Include values")
         try:
             if len(include_values) == 1:
-                values_array = zarr_root[f"{modality}/{uuid}/{include_values[0]}"]
+                values_array = get_table("zarr_root")[f"{modality}/{uuid}/{include_values[0]}"]
                 values_array = np.nan_to_num(values_array)
                 values_dict_list = [{include_values[0]: float(val)} for val in values_array]
                 values_series = pd.Series(values_dict_list, index=cell_df.index)
-                cell_df["values"] = values_series
+                # Assigned to a new frame, the dataset's frame can be shared between pages
+                cell_df = cell_df.assign(values=values_series)
                 cell_df = cell_df[offset:limit]
                 cell_dict_list = cell_df.to_json(orient="records")
                 print("Try succeeded")
 
-                return copy_pagination_format(cell_dict_list)
+                return copy_pagination_format(cell_dict_list, next_cursor)
             else:
                 cell_df = cell_df[offset:limit]
 
@@ -159,56 +177,37 @@ def get_dataset_cells(uuid, include_values, offset, limit):
         return cell_dict_list
 
 
-def get_max_value_items(query_set, limit, values_dict, offset):
-    identifiers = []
-
-    if query_set.count() == 0:
-        return query_set.filter(pk__in=[])
-
-    limit = min(limit, query_set.count())
-
-    for i in range(limit):
-
-        k = list(values_dict.keys())
-        v = list(values_dict.values())
-
-        if i >= offset:
-            identifiers.append(k[v.index(max(v))])
-        values_dict.pop(k[v.index(max(v))])
-
-    if isinstance(query_set.first(), Cell):
-        q = Q(cell_id__in=identifiers)
-
-    elif isinstance(query_set.first(), Gene):
-        q = Q(gene_symbol__in=identifiers)
-
-    elif isinstance(query_set.first(), Organ):
-        q = Q(grouping_name__in=identifiers)
-
-    elif isinstance(query_set.first(), Cluster):
-        q = Q(grouping_name__in=identifiers)
-
-    return query_set.filter(q)
-
-
-def order_query_set(query_set, limit, values_dict, offset):
-    vals_dict = {}
-    for item in query_set:
-        if isinstance(item, Cell):
-            identifier = item.cell_id
-        elif isinstance(item, Gene):
-            identifier = item.gene_symbol
-        elif isinstance(item, Organ):
-            identifier = item.grouping_name
-        elif isinstance(item, Cluster):
-            identifier = item.grouping_name
-
-        if identifier in values_dict.keys():
-            vals_dict[identifier] = values_dict[identifier]
-        else:
-            vals_dict[identifier] = 0.0
+sorted_cell_pks_cache = LRUCache(
+    settings.SORTED_HANDLE_CACHE_MAX_ENTRIES, settings.SORTED_HANDLE_CACHE_MAX_BYTES
+)
 
-    return get_max_value_items(query_set, limit, vals_dict, offset)
+# Field each kind of set is distinct on
+identifier_fields = {
+    Cell: "cell_id",
+    CellType: "grouping_name",
+    Cluster: "grouping_name",
+    Dataset: "uuid",
+    Gene: "gene_symbol",
+    Organ: "grouping_name",
+    Protein: "protein_id",
+}
+
+
+def rank_top_values(values: np.ndarray, identifiers: np.ndarray, k: int) -> np.ndarray:
+    """np.ndarray, np.ndarray, int -> np.ndarray
+    Finds the indices of the k largest values in descending order without sorting everything,
+    ties are broken by identifier so that pages are stable across requests"""
+    values = np.nan_to_num(values.astype(float), nan=-np.inf)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(values):
+        kth_value = values[np.argpartition(-values, k - 1)[k - 1]]
+        # Every value tied with the kth is a candidate, the identifiers decide between them
+        candidates = np.flatnonzero(values >= kth_value)
+    else:
+        candidates = np.arange(len(values))
+    order = np.lexsort((identifiers[candidates], -values[candidates]))
+    return candidates[order][:k]
 
 
 def get_percentages(query_set, include_values, values_type):
@@ -254,96 +253,430 @@ def query_set_count(self, request):
         return get_qs_count(query_params)
 
 
-def evaluate_qs(set_type, key, limit, offset):
-    evaluated_set = unpickle_query_set(query_handle=key, set_type=set_type)
-    if set_type == "cell":
-        evaluated_set = Cell.objects.filter(pk__in=evaluated_set.values_list("pk", flat=True))
-        evaluated_set = evaluated_set.distinct("cell_id")
-    elif set_type == "dataset":
-        evaluated_set = Dataset.objects.filter(pk__in=evaluated_set.values_list("pk", flat=True))
-        evaluated_set = evaluated_set.distinct("uuid")
-    evaluated_set = evaluated_set[offset:limit]
-    return evaluated_set
+def get_cursor_position(cursor):
+    """str -> Tuple[int, Optional[str]]
+    Offset and keyset value of the page a cursor points to"""
+    kind, value = decode_cursor(cursor)
+    if kind == "offset":
+        return int(value), None
+    return 0, value
+
+
+def get_cursor_page(cursor, limit, offset):
+    """Optional[str], int, int -> Tuple[int, int, Optional[str]]
+    Replaces offset with the position of a cursor, keeping the page size"""
+    if not cursor:
+        return limit, offset, None
+    page_size = limit - offset
+    offset, after = get_cursor_position(cursor)
+    return offset + page_size, offset, after
+
+
+def get_offset_cursor(limit, total):
+    return encode_cursor("offset", limit) if limit < total else None
+
+
+def get_keyset_cursor(page_length, page_size, last_value):
+    return encode_cursor("after", last_value) if 0 < page_length == page_size else None
+
+
+def get_list_evaluation_args(request):
+    query_params = request.data.dict()
+    set_type = query_params["set_type"]
+    set_type = "cell_type" if set_type == "celltype" else set_type
+
+    validate_list_evaluation_args(query_params)
+    key, include_values, sort_by, limit, offset = process_evaluation_args(query_params)
+    limit, offset, after = get_cursor_page(query_params.get("cursor"), limit, offset)
+    return set_type, key, include_values, limit, offset, after
 
 
 def evaluation_list(self, request):
     if request.method == "POST":
-        query_params = request.data.dict()
-        set_type = query_params["set_type"]
-        set_type = "cell_type" if set_type == "celltype" else set_type
+        set_type, key, include_values, limit, offset, after = get_list_evaluation_args(request)
+        return evaluate_list_page(
+            self, request, set_type, key, include_values, limit, offset, after
+        )
 
-        validate_list_evaluation_args(query_params)
-        key, include_values, sort_by, limit, offset = process_evaluation_args(query_params)
 
-        if key in hash_dict:
-            cell_dict_list = get_dataset_cells(hash_dict[key], include_values, offset, limit)
-            return cell_dict_list
+def evaluation_list_stream(self, request):
+    if request.method == "POST":
+        set_type, key, include_values, limit, offset, after = get_list_evaluation_args(request)
+        evaluate_page = partial(
+            evaluate_list_page, self, request, set_type, key, include_values, dataset_frames={}
+        )
+        return iterate_pages(self, evaluate_page, limit, offset, after)
+
+
+def evaluate_list_page(
+    self, request, set_type, key, include_values, limit, offset, after=None, dataset_frames=None
+):
+    if key in hash_dict and after is None:
+        self.next_cursor = get_offset_cursor(limit, count_dict.get(key, 0))
+        cell_dict_list = get_dataset_cells(
+            hash_dict[key], include_values, offset, limit, self.next_cursor, dataset_frames
+        )
+        return cell_dict_list
 
-        eval_qs = evaluate_qs(set_type, key, limit, offset)
-        self.queryset = eval_qs
-        # Set context
-        context = {
-            "request": request,
-        }
+    if set_type == "cell":
+        page_pks, self.next_cursor = get_page_cell_pks(key, limit, offset, after)
+        cell_dict_list = get_columnar_cells(page_pks)
+        if cell_dict_list is not None:
+            return cell_dict_list
 
-        if set_type == "cell":
-            response = CellSerializer(eval_qs, many=True, context=context).data
-        if set_type == "gene":
-            response = GeneSerializer(eval_qs, many=True, context=context).data
-        if set_type == "cluster":
-            response = ClusterSerializer(eval_qs, many=True, context=context).data
-        if set_type == "organ":
-            response = OrganSerializer(eval_qs, many=True, context=context).data
-        if set_type == "dataset":
-            response = DatasetSerializer(eval_qs, many=True, context=context).data
-        if set_type == "protein":
-            response = ProteinSerializer(eval_qs, many=True, context=context).data
-        if set_type == "cell_type":
-            response = CellTypeSerializer(eval_qs, many=True, context=context).data
+    eval_qs, self.next_cursor = evaluate_qs(set_type, key, limit, offset, after)
+    self.queryset = eval_qs
+    # Set context
+    context = {
+        "request": request,
+    }
 
-        return response
+    if set_type == "cell":
+        response = CellSerializer(eval_qs, many=True, context=context).data
+    if set_type == "gene":
+        response = GeneSerializer(eval_qs, many=True, context=context).data
+    if set_type == "cluster":
+        response = ClusterSerializer(eval_qs, many=True, context=context).data
+    if set_type == "organ":
+        response = OrganSerializer(eval_qs, many=True, context=context).data
+    if set_type == "dataset":
+        response = DatasetSerializer(eval_qs, many=True, context=context).data
+    if set_type == "protein":
+        response = ProteinSerializer(eval_qs, many=True, context=context).data
+    if set_type == "cell_type":
+        response = CellTypeSerializer(eval_qs, many=True, context=context).data
+
+    return response
+
+
+def get_detail_evaluation_args(request):
+    query_params = request.data.dict()
+    set_type = query_params["set_type"]
+    set_type = "cell_type" if set_type == "celltype" else set_type
+    query_params["values_included"] = request.POST.getlist("values_included")
+    validate_detail_evaluation_args(query_params)
+    key, include_values, sort_by, limit, offset = process_evaluation_args(query_params)
+    limit, offset, after = get_cursor_page(query_params.get("cursor"), limit, offset)
+    return set_type, key, include_values, sort_by, limit, offset, after
 
 
 def evaluation_detail(self, request):
     if request.method == "POST":
-        query_params = request.data.dict()
-        set_type = query_params["set_type"]
-        set_type = "cell_type" if set_type == "celltype" else set_type
-        query_params["values_included"] = request.POST.getlist("values_included")
-        validate_detail_evaluation_args(query_params)
-        key, include_values, sort_by, limit, offset = process_evaluation_args(query_params)
-
-        if key in hash_dict:
-            cell_dict_list = get_dataset_cells(hash_dict[key], include_values, offset, limit)
+        args = get_detail_evaluation_args(request)
+        return evaluate_detail_page(self, request, *args)
+
+
+def evaluation_detail_stream(self, request):
+    if request.method == "POST":
+        set_type, key, include_values, sort_by, limit, offset, after = get_detail_evaluation_args(
+            request
+        )
+        evaluate_page = partial(
+            evaluate_detail_page,
+            self,
+            request,
+            set_type,
+            key,
+            include_values,
+            sort_by,
+            dataset_frames={},
+        )
+        return iterate_pages(self, evaluate_page, limit, offset, after)
+
+
+def evaluate_detail_page(
+    self,
+    request,
+    set_type,
+    key,
+    include_values,
+    sort_by,
+    limit,
+    offset,
+    after=None,
+    dataset_frames=None,
+):
+    if sort_by is None and key in hash_dict and after is None:
+        self.next_cursor = get_offset_cursor(limit, count_dict.get(key, 0))
+        cell_dict_list = get_dataset_cells(
+            hash_dict[key], include_values, offset, limit, self.next_cursor, dataset_frames
+        )
+        return cell_dict_list
+
+    if set_type == "cell":
+        if sort_by is not None:
+            page_pks, self.next_cursor = get_sorted_page_pks(key, sort_by, limit, offset)
+        else:
+            page_pks, self.next_cursor = get_page_cell_pks(key, limit, offset, after)
+        cell_dict_list = get_columnar_cells(page_pks, request.POST.getlist("values_included"))
+        if cell_dict_list is not None:
             return cell_dict_list
 
-        eval_qs = evaluate_qs(set_type, key, limit, offset)
+    if sort_by is not None and set_type == "cell":
+        eval_qs = evaluate_sorted_cells(key, sort_by, limit, offset)
+    else:
+        eval_qs, self.next_cursor = evaluate_qs(set_type, key, limit, offset, after)
 
-        self.queryset = eval_qs
-        # Set context
-        context = {
-            "request": request,
-        }
+    self.queryset = eval_qs
+    # Set context
+    context = {
+        "request": request,
+    }
+
+    if set_type == "cell":
+        eval_qs = list(eval_qs)
+        context["values"] = get_quant_values(
+            [cell.pk for cell in eval_qs], request.POST.getlist("values_included")
+        )
+        response = CellAndValuesSerializer(eval_qs, many=True, context=context).data
+    if set_type == "gene":
+        response = GeneAndValuesSerializer(eval_qs, many=True, context=context).data
+    if set_type == "cluster":
+        response = ClusterAndValuesSerializer(eval_qs, many=True, context=context).data
+    if set_type == "organ":
+        response = OrganAndValuesSerializer(eval_qs, many=True, context=context).data
+    if set_type == "dataset":
+        response = DatasetAndValuesSerializer(eval_qs, many=True, context=context).data
+    if set_type == "protein":
+        response = ProteinSerializer(eval_qs, many=True, context=context).data
+    if set_type == "cell_type":
+        response = CellTypeSerializer(eval_qs, many=True, context=context).data
+
+    return response
+
+
+def get_page_records(page):
+    # get_dataset_cells can return an already paginated JSON document
+    if isinstance(page, str):
+        return json.loads(page)["results"]
+    return page
+
+
+def iterate_pages(self, evaluate_page, limit, offset, after=None):
+    """Callable, int, int, Optional[str] -> Iterator[List[dict]]
+    Evaluates the records from offset to limit in batches of STREAM_BATCH_SIZE,
+    so that only one batch is held in memory at a time.
+    Each batch continues from the cursor of the previous one"""
+    remaining = limit - offset
+    while remaining > 0:
+        batch_size = min(settings.STREAM_BATCH_SIZE, remaining)
+        batch = get_page_records(evaluate_page(offset + batch_size, offset, after))
+        if len(batch) > 0:
+            yield batch
+        remaining -= len(batch)
+        if len(batch) < batch_size or self.next_cursor is None:
+            break
+        offset, after = get_cursor_position(self.next_cursor)
+
+
+def uncombine_query_set(query_set):
+    """QuerySet -> QuerySet
+    Difference handles hold combined query sets, which can't be filtered or given related
+    objects to load; this selects the same members by primary key from a plain query set,
+    distinct on the field pages are keyed on like the handles' own query sets"""
+    if query_set.query.combinator:
+        model = query_set.model
+        query_set = model.objects.filter(pk__in=query_set.values("pk"))
+        return query_set.distinct(identifier_fields[model])
+    return query_set
+
+
+def with_cell_relations(query_set):
+    """QuerySet -> QuerySet
+    Loads the foreign keys and clusters the cell serializers read along with the cells,
+    in a constant number of queries per page instead of several per cell"""
+    return query_set.select_related("modality", "dataset", "organ", "cell_type").prefetch_related(
+        "clusters"
+    )
+
+
+def page_query_set(query_set, limit, offset, after=None):
+    """QuerySet, int, int, Optional[str] -> Tuple[QuerySet, str]
+    Orders a handle's query set on its distinct field and selects one page of it.
+    Pages after a cursor filter on that field rather than using OFFSET,
+    so Postgres starts from the index instead of rescanning every skipped row"""
+    field = identifier_fields[query_set.model]
+    query_set = uncombine_query_set(query_set).order_by(field)
+    if after is not None:
+        query_set = query_set.filter(**{f"{field}__gt": after})
+    return query_set[offset:limit], field
+
+
+def evaluate_qs(set_type, key, limit, offset, after=None):
+    """-> Tuple[Iterable[Model], Optional[str]]
+    Evaluates one page of a handle, along with the cursor of the next page"""
+    if set_type == "cell":
+        cell_pks = get_cell_pks(key)
+        if cell_pks is not None:
+            page_pks = cell_pks[offset:limit].tolist()
+            evaluated_set = with_cell_relations(
+                Cell.objects.filter(pk__in=page_pks).order_by("pk")
+            )
+            return evaluated_set, get_offset_cursor(limit, len(cell_pks))
 
-        if set_type == "cell":
-            response = CellAndValuesSerializer(eval_qs, many=True, context=context).data
-        if set_type == "gene":
-            response = GeneAndValuesSerializer(eval_qs, many=True, context=context).data
-        if set_type == "cluster":
-            response = ClusterAndValuesSerializer(eval_qs, many=True, context=context).data
-        if set_type == "organ":
-            response = OrganAndValuesSerializer(eval_qs, many=True, context=context).data
-        if set_type == "dataset":
-            response = DatasetAndValuesSerializer(eval_qs, many=True, context=context).data
-        if set_type == "protein":
-            response = ProteinSerializer(eval_qs, many=True, context=context).data
-        if set_type == "cell_type":
-            response = CellTypeSerializer(eval_qs, many=True, context=context).data
-
-        return response
-
-
-def evaluate_qs(set_type, key, limit, offset):
     evaluated_set, set_type = unpickle_query_set(query_handle=key)
-    evaluated_set = evaluated_set[offset:limit]
-    return evaluated_set
+    evaluated_set = uncombine_query_set(evaluated_set)
+    if set_type == "cell":
+        evaluated_set = with_cell_relations(evaluated_set)
+    evaluated_set, field = page_query_set(evaluated_set, limit, offset, after)
+    evaluated_set = list(evaluated_set)
+    last_value = getattr(evaluated_set[-1], field) if evaluated_set else None
+    return evaluated_set, get_keyset_cursor(len(evaluated_set), limit - offset, last_value)
+
+
+def get_handle_cell_pks(key):
+    cell_pks = get_cell_pks(key)
+    if cell_pks is None:
+        query_set = unpickle_query_set(key)[0]
+        cell_pks = materialize_cell_pks(query_set)
+        save_handle_cell_pks(key, cell_pks)
+    return cell_pks
+
+
+def get_page_cell_pks(key, limit, offset, after=None):
+    """str, int, int, Optional[str] -> Tuple[np.ndarray, Optional[str]]
+    Primary keys of one page of a cell handle, in the order evaluate_qs returns its cells,
+    along with the cursor of the next page"""
+    cell_pks = get_cell_pks(key)
+    if cell_pks is not None:
+        return cell_pks[offset:limit], get_offset_cursor(limit, len(cell_pks))
+    query_set = unpickle_query_set(key)[0]
+    query_set, field = page_query_set(query_set, limit, offset, after)
+    page = list(query_set.values_list("pk", field))
+    page_pks = np.array([pk for pk, value in page], dtype=np.int64)
+    last_value = page[-1][1] if page else None
+    return page_pks, get_keyset_cursor(len(page), limit - offset, last_value)
+
+
+def get_sorted_page_pks(key, sort_by, limit, offset):
+    ranked_pks, total = get_sorted_cell_pks(key, sort_by, limit)
+    return ranked_pks[offset:limit], get_offset_cursor(limit, total)
+
+
+def get_cell_frame(page_pks, values_included=()):
+    """np.ndarray, Iterable[str] -> Optional[pd.DataFrame]
+    Slices the rows of a page of cells out of the cell DataFrames, in page order,
+    with a float column for each gene or protein in values_included.
+    Returns None if a cell of the page has no row in the DataFrames"""
+    keep_columns = ["cell_id", "modality", "dataset", "organ", "cell_type", "clusters"]
+    page_dfs = []
+    for modality in cell_modalities:
+        found, positions = pks_to_positions(modality, page_pks)
+        if len(positions) == 0:
+            continue
+        page_df = (
+            get_cell_df(modality).iloc[get_position_rows(modality)[positions]][keep_columns].copy()
+        )
+        page_df.index = np.flatnonzero(found)
+        for var_id in values_included:
+            page_df[var_id] = read_quant_values(modality, var_id, positions)
+        page_dfs.append(page_df)
+
+    if sum(len(page_df) for page_df in page_dfs) < len(page_pks):
+        return None
+    if len(page_dfs) == 0:
+        return pd.DataFrame(columns=keep_columns + list(values_included))
+
+    page_df = pd.concat(page_dfs).sort_index()
+    if isinstance(page_df["clusters"].iloc[0], str):
+        page_df["clusters"] = [clusters.split(",") for clusters in page_df["clusters"]]
+    return page_df.reset_index(drop=True)
+
+
+def get_columnar_cells(page_pks, values_included=None):
+    """np.ndarray, Optional[List[str]] -> Optional[List[dict]]
+    Builds the records of a page of cells from the cell DataFrames,
+    bypassing the ORM and serializers as get_dataset_cells does for whole datasets.
+    Returns None if a cell of the page has no row in the DataFrames"""
+    page_df = get_cell_frame(page_pks)
+    if page_df is None:
+        return None
+    records = page_df.to_dict(orient="records")
+
+    if values_included is not None:
+        values_dict = get_quant_values(page_pks, values_included)
+        for pk, record in zip(page_pks.tolist(), records):
+            record["values"] = values_dict[pk]
+
+    return records
+
+
+def records_to_frame(records, values_included=()):
+    """List[dict], Iterable[str] -> pd.DataFrame
+    Flattens serialized cell records into the layout of get_cell_frame"""
+    page_df = pd.DataFrame.from_records(records)
+    if "values" in page_df.columns:
+        values_df = pd.DataFrame.from_records(list(page_df.pop("values")), index=page_df.index)
+        page_df = page_df.join(values_df.reindex(columns=list(values_included)).astype(float))
+    return page_df
+
+
+def evaluation_list_frame(self, request):
+    if request.method == "POST":
+        set_type, key, include_values, limit, offset, after = get_list_evaluation_args(request)
+        page_pks, self.next_cursor = get_page_cell_pks(key, limit, offset, after)
+        page_df = get_cell_frame(page_pks)
+        if page_df is None:
+            page = evaluate_list_page(
+                self, request, set_type, key, include_values, limit, offset, after
+            )
+            page_df = records_to_frame(get_page_records(page))
+        return page_df
+
+
+def evaluation_detail_frame(self, request):
+    if request.method == "POST":
+        args = get_detail_evaluation_args(request)
+        set_type, key, include_values, sort_by, limit, offset, after = args
+        values_included = request.POST.getlist("values_included")
+        if sort_by is not None:
+            page_pks, self.next_cursor = get_sorted_page_pks(key, sort_by, limit, offset)
+        else:
+            page_pks, self.next_cursor = get_page_cell_pks(key, limit, offset, after)
+        page_df = get_cell_frame(page_pks, values_included)
+        if page_df is None:
+            page = evaluate_detail_page(self, request, *args)
+            page_df = records_to_frame(get_page_records(page), values_included)
+        return page_df
+
+
+def sort_cell_pks(cell_pks, var_id, k):
+    """np.ndarray, str, int -> np.ndarray
+    The k cells with the highest values of a gene or protein, in descending order. Values of all
+    cells are read at once, but only the top k are sorted; cells without a value come last and
+    ties are broken by primary key"""
+    values = np.full(len(cell_pks), np.nan)
+    for modality in cell_modalities:
+        found, positions = pks_to_positions(modality, cell_pks)
+        values[found] = read_quant_values(modality, var_id, positions)
+    return cell_pks[rank_top_values(values, cell_pks, k)]
+
+
+def get_sorted_cell_pks(key, sort_by, limit):
+    """str, str, int -> Tuple[np.ndarray, int]
+    The cells of a handle ranked by sort_by down to at least position limit, along with the
+    size of the handle. The ranked prefix is cached per sort_by value, and ranked again twice
+    as deep when a later page goes past it"""
+    split_sort_by = split_at_comparator(sort_by)
+    var_id = (split_sort_by[0] if split_sort_by else sort_by).strip()
+    cached = sorted_cell_pks_cache.get((key, var_id))
+    if cached is not None and min(limit, cached[1]) <= len(cached[0]):
+        return cached
+    cell_pks = get_handle_cell_pks(key)
+    k = limit if cached is None else max(limit, 2 * len(cached[0]))
+    ranked_pks = sort_cell_pks(cell_pks, var_id, k)
+    ranked_pks.setflags(write=False)
+    sorted_cell_pks_cache.put(
+        (key, var_id),
+        (ranked_pks, len(cell_pks)),
+        expires_at=time() + settings.TOKEN_EXPIRATION_TIME,
+        size=ranked_pks.nbytes,
+    )
+    return ranked_pks, len(cell_pks)
+
+
+def evaluate_sorted_cells(key, sort_by, limit, offset):
+    page_pks = get_sorted_cell_pks(key, sort_by, limit)[0][offset:limit].tolist()
+    ranks = {pk: rank for rank, pk in enumerate(page_pks)}
+    cells = with_cell_relations(Cell.objects.filter(pk__in=page_pks))
+    return sorted(cells, key=lambda cell: ranks[cell.pk])
@@ -1,4 +1,8 @@
+import numpy as np
+
 from .utils import (
+    get_cell_pks,
+    get_count_bounds,
     get_response_from_query_handle,
     make_pickle_and_hash,
     unpickle_query_set,
@@ -10,7 +14,8 @@ def query_set_intersection(self, request):
         params = request.data.dict()
         pickle_hash = qs_intersect(params)
         set_type = params["set_type"]
-        return get_response_from_query_handle(pickle_hash, set_type)
+        count_bounds = get_count_bounds(pickle_hash)
+        return get_response_from_query_handle(pickle_hash, set_type, count_bounds)
 
 
 def query_set_union(self, request):
@@ -18,7 +23,8 @@ def query_set_union(self, request):
         params = request.data.dict()
         pickle_hash = qs_union(params)
         set_type = params["set_type"]
-        return get_response_from_query_handle(pickle_hash, set_type)
+        count_bounds = get_count_bounds(pickle_hash)
+        return get_response_from_query_handle(pickle_hash, set_type, count_bounds)
 
 
 def query_set_difference(self, request):
@@ -26,37 +32,78 @@ def query_set_difference(self, request):
         params = request.data.dict()
         pickle_hash = qs_subtract(params)
         set_type = params["set_type"]
-        return get_response_from_query_handle(pickle_hash, set_type)
+        count_bounds = get_count_bounds(pickle_hash)
+        return get_response_from_query_handle(pickle_hash, set_type, count_bounds)
 
 
-def qs_intersect(params):
+def combine_cell_pks(pickle_hash_1, pickle_hash_2, pks_operation):
+    """str, str, Callable -> Optional[np.ndarray]
+    Applies a set operation to the materialized primary keys of two cell handles in memory,
+    returns None if either handle is not materialized"""
+    cell_pks_1 = get_cell_pks(pickle_hash_1)
+    if cell_pks_1 is None:
+        return None
+    cell_pks_2 = get_cell_pks(pickle_hash_2)
+    if cell_pks_2 is None:
+        return None
+    return pks_operation(cell_pks_1, cell_pks_2)
+
+
+def intersection_bounds(bounds_1, bounds_2):
+    return 0, min(bounds_1[1], bounds_2[1])
+
+
+def union_bounds(bounds_1, bounds_2):
+    return max(bounds_1[0], bounds_2[0]), bounds_1[1] + bounds_2[1]
+
+
+def difference_bounds(bounds_1, bounds_2):
+    return max(bounds_1[0] - bounds_2[1], 0), bounds_1[1]
+
+
+def combine_count_bounds(pickle_hash_1, pickle_hash_2, bounds_operation):
+    """str, str, Callable -> Optional[Tuple[int, int]]
+    Derives bounds on the size of a combined set from what is known about its operands,
+    e.g. |A ∪ B| <= |A| + |B|, without counting anything"""
+    bounds_1 = get_count_bounds(pickle_hash_1)
+    bounds_2 = get_count_bounds(pickle_hash_2)
+    if bounds_1 is None or bounds_2 is None:
+        return None
+    return bounds_operation(bounds_1, bounds_2)
+
+
+def qs_combine(params, qs_operation, pks_operation, bounds_operation):
     pickle_hash_1 = params["key_one"]
     pickle_hash_2 = params["key_two"]
     set_type = params["set_type"]
     qs1 = unpickle_query_set(pickle_hash_1)[0]
     qs2 = unpickle_query_set(pickle_hash_2)[0]
-    qs = qs1 & qs2
-    pickle_hash = make_pickle_and_hash(qs, set_type)
+    qs = qs_operation(qs1, qs2)
+    cell_pks = None
+    if set_type == "cell":
+        cell_pks = combine_cell_pks(pickle_hash_1, pickle_hash_2, pks_operation)
+    count_bounds = combine_count_bounds(pickle_hash_1, pickle_hash_2, bounds_operation)
+    pickle_hash = make_pickle_and_hash(qs, set_type, cell_pks=cell_pks, count_bounds=count_bounds)
     return pickle_hash
 
 
+def qs_intersect(params):
+    return qs_combine(
+        params,
+        lambda qs1, qs2: qs1 & qs2,
+        lambda pks1, pks2: np.intersect1d(pks1, pks2, assume_unique=True),
+        intersection_bounds,
+    )
+
+
 def qs_union(params):
-    pickle_hash_1 = params["key_one"]
-    pickle_hash_2 = params["key_two"]
-    set_type = params["set_type"]
-    qs1 = unpickle_query_set(pickle_hash_1)[0]
-    qs2 = unpickle_query_set(pickle_hash_2)[0]
-    qs = qs1 | qs2
-    pickle_hash = make_pickle_and_hash(qs, set_type)
-    return pickle_hash
+    return qs_combine(params, lambda qs1, qs2: qs1 | qs2, np.union1d, union_bounds)
 
 
 def qs_subtract(params):
-    pickle_hash_1 = params["key_one"]
-    pickle_hash_2 = params["key_two"]
-    set_type = params["set_type"]
-    qs1 = unpickle_query_set(pickle_hash_1)[0]
-    qs2 = unpickle_query_set(pickle_hash_2)[0]
-    qs = qs1.difference(qs2)
-    pickle_hash = make_pickle_and_hash(qs, set_type)
-    return pickle_hash
+    return qs_combine(
+        params,
+        lambda qs1, qs2: qs1.difference(qs2),
+        lambda pks1, pks2: np.setdiff1d(pks1, pks2, assume_unique=True),
+        difference_bounds,
+    )
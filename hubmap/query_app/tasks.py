@@ -2,3 +2,10 @@ from datetime import datetime
 
 from celery import shared_task
 from django.conf import settings
+
+from .utils import get_handle_count
+
+
+@shared_task
+def fill_handle_count(query_handle):
+    return get_handle_count(query_handle)
@@ -1,6 +1,45 @@
+import json
+import pickle
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from typing import List
-
-from django.test import Client, TestCase
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import zarr
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from build_value_index import build_chunk_summaries, build_value_index
+
+from .analysis import get_statistic_value, get_var_moments
+from .apps import make_handle_doc, read_handle_manifest, write_handle_manifest
+from .cell_index import (
+    get_position_pks,
+    pks_to_positions,
+    positions_to_pks,
+    read_quant_values,
+)
+from .data_registry import DataRegistry, compact_frame
+from .filters import (
+    condition_pks_cache,
+    get_conditions_positions,
+    get_indexed_positions,
+    operators_dict,
+    scan_conditions,
+)
+from .handle_store import SQLiteHandleStore, get_handle_store, handle_cache
+from .models import Cell, Dataset, Modality
+from .set_evaluators import (
+    get_dataset_frame,
+    get_handle_cell_pks,
+    page_query_set,
+    rank_top_values,
+)
+from .timing import get_phase_timings
 
 c = Client()
 
@@ -73,6 +112,49 @@ def set_list_evaluation(set_key: str, set_type: str, limit: int, offset=0):
     return response_json
 
 
+def get_query_only_difference() -> str:
+    """All cells but those from the heart, as a handle that keeps only its query and
+    isn't materialized. Meant to be called with MATERIALIZE_CELL_HANDLES off"""
+    handle_cache.clear()
+    all_cells = get_all("cell")
+    heart_cells = hubmap_query("organ", "cell", ["Heart"])
+    difference_cells = set_difference(all_cells, heart_cells, "cell")
+    assert "cell_pks" not in get_handle_store().get(difference_cells)
+    return difference_cells
+
+
+def use_rna_values(test_case: TestCase, var_ids: List[str]) -> dict:
+    """Stands in an RNA cell DataFrame and zarr arrays covering the fixture's RNA cells for the
+    rest of a test, and returns the values of each variable. Values are in primary key order,
+    and missing for every seventh cell"""
+    cell_ids = Cell.objects.filter(modality__modality_name="rna").order_by("pk")
+    cell_ids = list(cell_ids.values_list("cell_id", flat=True))
+    cell_df = pd.DataFrame({"cell_id": cell_ids, "int_index": np.arange(len(cell_ids))})
+    zarr_root = zarr.group()
+    rng = np.random.default_rng(0)
+    var_values = {}
+    for var_id in var_ids:
+        values = rng.normal(5.0, 2.0, len(cell_ids))
+        values[::7] = np.nan
+        zarr_root.array(f"rna/{var_id}", values, chunks=(100,))
+        var_values[var_id] = values
+    tables = {"rna_cell_df": cell_df.sort_values("cell_id"), "zarr_root": zarr_root}
+    start_patches(test_case, [patch.dict("query_app.data_registry.data_registry.tables", tables)])
+    return var_values
+
+
+def start_patches(test_case: TestCase, patchers: List):
+    """Applies patchers for the rest of a test, along with empty cell_index and condition
+    caches so that row positions are mapped from the patched tables"""
+    for cache in ["position_pks", "duplicate_pks", "sorted_position_pks", "position_rows"]:
+        patchers.append(patch.dict(f"query_app.cell_index.{cache}_dict", clear=True))
+    for patcher in patchers:
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+    condition_pks_cache.clear()
+    test_case.addCleanup(condition_pks_cache.clear)
+
+
 def get_response_code(request_url, request_dict):
     response = c.post(request_url, request_dict)
     return response.status_code
@@ -119,6 +201,17 @@ class CellTestCase(TestCase):
         "protein.json",
     ]
 
+    def test_cells_from_gene_values(self):
+        values = use_rna_values(self, ["CD9"])["CD9"]
+        cells = hubmap_query("gene", "cell", ["CD9 > 5"], genomic_modality="rna")
+        self.assertEqual(set_count(cells, "cell"), np.count_nonzero(values > 5))
+        # The handle holds the condition rather than the primary keys of the cells meeting it
+        query_pickle = get_handle_store().get(cells)["query_pickle"]
+        condition_pks = pickle.loads(query_pickle).where.children[0].rhs
+        self.assertEqual(condition_pks.split_conditions, [["CD9", ">", "5"]])
+        self.assertEqual(condition_pks.params, ())
+        self.assertEqual(hubmap_query("gene", "cell", ["CD9 > 5"], genomic_modality="rna"), cells)
+
     def test_all_cells(self):
         all_cells = get_all("cell")
         all_cells_count = set_count(all_cells, "cell")
@@ -428,6 +521,72 @@ class OperationsTestCase(TestCase):
         intersection_cells_count = set_count(intersection_cells, "cell")
         self.assertEqual(intersection_cells_count, 180)
 
+    def test_chained_operations(self):
+        cells_from_dataset = hubmap_query("dataset", "cell", ["d4493657cde29702c5ed73932da5317c"])
+        cells_from_organ = hubmap_query("organ", "cell", ["Spleen"])
+        union_cells = set_union(cells_from_dataset, cells_from_organ, "cell")
+        intersection_cells = set_intersection(cells_from_dataset, cells_from_organ, "cell")
+        difference_cells = set_difference(union_cells, intersection_cells, "cell")
+        self.assertEqual(
+            set_count(difference_cells, "cell"),
+            set_count(union_cells, "cell") - set_count(intersection_cells, "cell"),
+        )
+
+
+class StatisticTestCase(TestCase):
+    fixtures = [
+        "cell.json",
+        "celltype.json",
+        "cluster.json",
+        "dataset.json",
+        "gene.json",
+        "modality.json",
+        "organ.json",
+        "protein.json",
+    ]
+
+    def test_mean(self):
+        values = use_rna_values(self, ["CD9"])
+        all_cells = get_all("cell")
+        request_dict = {"key": all_cells, "set_type": "cell", "var_id": "CD9"}
+        response = c.post(base_url + "mean/", request_dict)
+        stat_report = response.json()["results"][0]
+        self.assertEqual(stat_report["statistic_type"], "mean")
+        self.assertAlmostEqual(stat_report["rna_value"], np.nanmean(values["CD9"]))
+        for modality in ["atac", "codex"]:
+            value = stat_report[f"{modality}_value"]
+            self.assertTrue(value is None or isinstance(value, float))
+
+    def test_empty_stat_types(self):
+        all_cells = get_all("cell")
+        request_dict = {"key": all_cells, "set_type": "cell", "var_ids": ["CD9"]}
+        self.assertEqual(get_response_code(base_url + "stats/", request_dict), 400)
+
+    def test_batch_stats(self):
+        use_rna_values(self, ["CD9", "USP9Y"])
+        all_cells = get_all("cell")
+        var_ids = ["CD9", "USP9Y"]
+        stat_types = ["mean", "max", "stddev"]
+        request_dict = {
+            "key": all_cells,
+            "set_type": "cell",
+            "var_ids": var_ids,
+            "stat_types": stat_types,
+        }
+        response = c.post(base_url + "stats/", request_dict)
+        stat_report = response.json()["results"][0]
+        for modality in ["rna", "atac", "codex"]:
+            stat_matrix = stat_report[f"{modality}_values"]
+            self.assertEqual([len(row) for row in stat_matrix], [3, 3])
+        # Each cell of the matrix is what the single statistic endpoint returns
+        for i, var_id in enumerate(var_ids):
+            for j, stat_type in enumerate(stat_types):
+                request_dict = {"key": all_cells, "set_type": "cell", "var_id": var_id}
+                response = c.post(base_url + f"{stat_type}/", request_dict)
+                value = response.json()["results"][0]["rna_value"]
+                self.assertIsNotNone(value)
+                self.assertAlmostEqual(stat_report["rna_values"][i][j], value)
+
 
 class ListEvaluationTestCase(TestCase):
     fixtures = [
@@ -450,6 +609,153 @@ class ListEvaluationTestCase(TestCase):
             ["cell_id", "modality", "dataset", "organ", "cell_type", "clusters"],
         )
 
+    def test_cell_pages(self):
+        all_cells = get_all("cell")
+        first_page = set_list_evaluation(all_cells, "cell", 5)
+        second_page = set_list_evaluation(all_cells, "cell", 5, offset=5)
+        first_ids = {cell["cell_id"] for cell in first_page}
+        second_ids = {cell["cell_id"] for cell in second_page}
+        self.assertEqual(len(first_ids), 5)
+        self.assertEqual(len(second_ids), 5)
+        self.assertEqual(first_ids & second_ids, set())
+        # Pages are slices of the primary keys stored with the handle
+        self.assertIn("cell_pks", get_handle_store().get(all_cells))
+        first_cells = Cell.objects.order_by("pk")[:10].values_list("cell_id", flat=True)
+        self.assertEqual(first_ids | second_ids, set(first_cells))
+
+    def test_cell_page_query_count(self):
+        all_cells = get_all("cell")
+        set_list_evaluation(all_cells, "cell", 1)
+        with CaptureQueriesContext(connection) as small_page_queries:
+            set_list_evaluation(all_cells, "cell", 2)
+        with CaptureQueriesContext(connection) as large_page_queries:
+            set_list_evaluation(all_cells, "cell", 8)
+        self.assertEqual(len(small_page_queries), len(large_page_queries))
+
+    @override_settings(MATERIALIZE_CELL_HANDLES=False)
+    def test_difference_page_query_count(self):
+        difference_cells = get_query_only_difference()
+        set_list_evaluation(difference_cells, "cell", 1)
+        with CaptureQueriesContext(connection) as small_page_queries:
+            small_page = set_list_evaluation(difference_cells, "cell", 2)
+        with CaptureQueriesContext(connection) as large_page_queries:
+            large_page = set_list_evaluation(difference_cells, "cell", 8)
+        self.assertEqual(len(small_page), 2)
+        self.assertEqual(len(large_page), 8)
+        self.assertEqual(len(small_page_queries), len(large_page_queries))
+
+    def test_precomputed_handle_cell_pks(self):
+        # Stored like the dataset and modality handles, without their cells' primary keys
+        query_set = Cell.objects.filter(modality__modality_name="rna").distinct("cell_id")
+        doc = make_handle_doc(query_set, "cell")
+        get_handle_store().put(doc)
+        cell_pks = get_handle_cell_pks(doc["query_handle"])
+        self.assertEqual(len(cell_pks), 1100)
+        self.assertIn("cell_pks", get_handle_store().get(doc["query_handle"]))
+        handle_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_handle_cell_pks(doc["query_handle"]).tolist(), cell_pks.tolist())
+
+    def test_cell_cursor(self):
+        all_cells = get_all("cell")
+        request_url = base_url + "cellevaluation/"
+        request_dict = {"key": all_cells, "set_type": "cell", "limit": 3}
+        first_page = c.post(request_url, request_dict).json()
+        request_dict["cursor"] = first_page["next"]
+        second_page = c.post(request_url, request_dict).json()["results"]
+        self.assertEqual(second_page, set_list_evaluation(all_cells, "cell", 3, offset=3))
+
+    @override_settings(MATERIALIZE_CELL_HANDLES=False)
+    def test_difference_cursor(self):
+        difference_cells = get_query_only_difference()
+        request_url = base_url + "cellevaluation/"
+        request_dict = {"key": difference_cells, "set_type": "cell", "limit": 3}
+        first_page = c.post(request_url, request_dict).json()
+        request_dict["cursor"] = first_page["next"]
+        second_page = c.post(request_url, request_dict).json()["results"]
+        self.assertEqual(second_page, set_list_evaluation(difference_cells, "cell", 3, offset=3))
+
+    def test_difference_pages_distinct_cells(self):
+        cell = Cell.objects.exclude(organ__grouping_name="Heart").first()
+        Cell.objects.create(cell_id=cell.cell_id, modality=cell.modality, organ=cell.organ)
+        heart_cells = Cell.objects.filter(organ__grouping_name="Heart")
+        difference = Cell.objects.all().difference(heart_cells)
+        cell_ids = []
+        after = None
+        while True:
+            page, field = page_query_set(difference, 100, 0, after)
+            page_ids = [page_cell.cell_id for page_cell in page]
+            if not page_ids:
+                break
+            cell_ids.extend(page_ids)
+            after = page_ids[-1]
+        expected_ids = Cell.objects.exclude(pk__in=heart_cells).values_list("cell_id", flat=True)
+        self.assertEqual(cell_ids, sorted(set(expected_ids)))
+
+    @override_settings(STREAM_BATCH_SIZE=2)
+    def test_cell_stream(self):
+        all_cells = get_all("cell")
+        request_dict = {"key": all_cells, "set_type": "cell", "limit": 5}
+        response = c.post(
+            base_url + "cellevaluation/", request_dict, HTTP_ACCEPT="application/x-ndjson"
+        )
+        lines = b"".join(response.streaming_content).splitlines()
+        streamed_cells = [json.loads(line) for line in lines]
+        self.assertEqual(streamed_cells, set_list_evaluation(all_cells, "cell", 5))
+
+    @override_settings(STREAM_BATCH_SIZE=2)
+    def test_dataset_cell_stream(self):
+        modality = Modality.objects.create(modality_name="codex")
+        Dataset.objects.create(uuid="stream-dataset", modality=modality)
+        cell_ids = [f"cell-{i}" for i in range(5)]
+        cell_df = pd.DataFrame(
+            {
+                "cell_id": ["other-cell"] + cell_ids,
+                "modality": "codex",
+                "dataset": ["other-dataset"] + ["stream-dataset"] * 5,
+                "organ": "Kidney",
+                "cell_type": "Unknown",
+                "clusters": "leiden-1",
+            }
+        )
+        start_patches(
+            self,
+            [
+                patch("query_app.set_evaluators.get_cell_df", return_value=cell_df),
+                patch.dict(
+                    "query_app.set_evaluators.hash_dict", {"dataset-key": "stream-dataset"}
+                ),
+                patch.dict("query_app.set_evaluators.count_dict", {"dataset-key": 5}),
+            ],
+        )
+        request_dict = {"key": "dataset-key", "set_type": "cell", "limit": 5}
+        with patch(
+            "query_app.set_evaluators.get_dataset_frame", wraps=get_dataset_frame
+        ) as dataset_frame_mock:
+            response = c.post(
+                base_url + "cellevaluation/", request_dict, HTTP_ACCEPT="application/x-ndjson"
+            )
+            lines = b"".join(response.streaming_content).splitlines()
+        streamed_cells = [json.loads(line) for line in lines]
+        self.assertEqual([cell["cell_id"] for cell in streamed_cells], cell_ids)
+        self.assertEqual(streamed_cells[0]["clusters"], ["leiden-1"])
+        # The batches page over one slice of the cell DataFrame
+        self.assertEqual(dataset_frame_mock.call_count, 1)
+
+    def test_cell_arrow(self):
+        all_cells = get_all("cell")
+        request_dict = {"key": all_cells, "set_type": "cell", "limit": 5}
+        response = c.post(
+            base_url + "cellevaluation/",
+            request_dict,
+            HTTP_ACCEPT="application/vnd.apache.arrow.stream",
+        )
+        table = pa.ipc.open_stream(response.content).read_all()
+        evaluated_cells = set_list_evaluation(all_cells, "cell", 5)
+        self.assertEqual(
+            table.column("cell_id").to_pylist(), [cell["cell_id"] for cell in evaluated_cells]
+        )
+
     def test_genes(self):
         all_genes = get_all("gene")
         evaluated_gene = set_list_evaluation(all_genes, "gene", 1)[0]
@@ -563,6 +869,14 @@ class ErrorTestCase(TestCase):
         response_code = get_response_code(request_url, request_dict)
         self.assertEqual(response_code, 400)
 
+    def test_invalid_stream_handle(self):
+        request_dict = {"key": "not a handle", "set_type": "cell", "limit": 5}
+        response = c.post(
+            base_url + "cellevaluation/", request_dict, HTTP_ACCEPT="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.streaming)
+
     def test_invalid_genomic_modalities(self):
         request_url = base_url + "dataset/"
         request_dict = {
@@ -606,3 +920,182 @@ class ErrorTestCase(TestCase):
         }
         response_code = get_response_code(request_url, request_dict)
         self.assertEqual(response_code, 400)
+
+
+class DataRegistryTestCase(SimpleTestCase):
+    def test_cached_table(self):
+        with TemporaryDirectory() as temp_dir:
+            source_path = Path(temp_dir) / "cell.hdf5"
+            source_path.touch()
+            cell_df = pd.DataFrame(
+                {"cell_id": ["b", "a"], "dataset": ["d", "d"], "clusters": [["x", "y"], ["z"]]}
+            ).set_index(["cell_id", "dataset"], drop=False)
+            loads = []
+
+            def load():
+                loads.append(source_path)
+                return cell_df
+
+            with override_settings(DATA_CACHE_DIR=Path(temp_dir) / "cache"):
+                for i in range(2):
+                    data_registry = DataRegistry()
+                    data_registry.register("cell_df", load, [source_path])
+                    self.assertTrue(data_registry.get("cell_df").equals(cell_df))
+        # The second registry memory-maps the table cached by the first
+        self.assertEqual(len(loads), 1)
+
+    def test_load_timing(self):
+        data_registry = DataRegistry()
+        data_registry.register("timed_df", pd.DataFrame)
+        data_registry.get("timed_df")
+        phases = [timing["phase"] for timing in get_phase_timings()]
+        self.assertIn("load timed_df", phases)
+
+    def test_compact_frame(self):
+        df = pd.DataFrame({"dataset": ["d", "d", "e"], "cell_type": ["t", None, "t"]})
+        records = df.to_dict(orient="records")
+        df = compact_frame(df)
+        self.assertEqual(df["dataset"].dtype, "category")
+        # Columns with missing values keep their None rather than becoming NaN
+        self.assertEqual(df["cell_type"].dtype, object)
+        self.assertEqual(df.to_dict(orient="records"), records)
+
+    def test_compact_only_preloaded(self):
+        for preload_tables, dtype in [(False, object), (True, "category")]:
+            data_registry = DataRegistry()
+            data_registry.register("dataset_df", lambda: pd.DataFrame({"dataset": ["d", "e"]}))
+            with override_settings(PRELOAD_TABLES=preload_tables):
+                self.assertEqual(data_registry.get("dataset_df")["dataset"].dtype, dtype)
+
+
+class HandleManifestTestCase(SimpleTestCase):
+    def test_manifest_version(self):
+        counts = {("dataset", "d"): 2, ("modality", "rna"): 5}
+        with TemporaryDirectory() as temp_dir:
+            with override_settings(HANDLE_MANIFEST_PATH=Path(temp_dir) / "handles.json"):
+                write_handle_manifest("version", counts)
+                self.assertEqual(read_handle_manifest("version"), counts)
+                self.assertIsNone(read_handle_manifest("other version"))
+
+
+class HandleStoreTestCase(SimpleTestCase):
+    def test_sqlite_put_replaces(self):
+        with TemporaryDirectory() as temp_dir:
+            handle_store = SQLiteHandleStore({"LOCATION": Path(temp_dir) / "handles.sqlite3"})
+            doc = {"query_handle": "h", "query_pickle": b"", "set_type": "cell", "count": 3}
+            handle_store.put(doc)
+            handle_store.put({key: value for key, value in doc.items() if key != "count"})
+            self.assertNotIn("count", handle_store.get("h"))
+            handle_store.update("h", {"count": 4})
+            self.assertEqual(handle_store.get("h")["count"], 4)
+            self.assertEqual(handle_store.get("h")["set_type"], "cell")
+
+
+class RankTestCase(SimpleTestCase):
+    def test_rank_top_values(self):
+        values = np.array([1.0, 3.0, 3.0, np.nan, 2.0, 3.0])
+        identifiers = np.array([10, 5, 7, 1, 3, 2])
+        # Ties by ascending identifier, missing values last
+        full_order = [5, 1, 2, 4, 0, 3]
+        self.assertEqual(rank_top_values(values, identifiers, len(values)).tolist(), full_order)
+        for limit in range(len(values) + 2):
+            for offset in range(limit + 1):
+                page = rank_top_values(values, identifiers, limit)[offset:limit]
+                self.assertEqual(page.tolist(), full_order[offset:limit])
+
+
+class IndexedFilterTestCase(SimpleTestCase):
+    def test_index_matches_scan(self):
+        root = zarr.group()
+        values = np.array([2.0, np.nan, 1.0, 3.0, 2.0, np.nan, 0.5, 2.0, 4.0, 1.0])
+        root.array("rna/CD4", values, chunks=(3,))
+        build_value_index(root, "rna", "CD4")
+        array = root["rna/CD4"]
+        with patch("query_app.filters.get_table", return_value=root):
+            for comparator, operator in operators_dict.items():
+                for value in [0.0, 1.0, 2.0, 2.5, 4.0, 5.0]:
+                    indexed_positions = get_indexed_positions("rna", "CD4", comparator, value)
+                    scanned_positions = scan_conditions([(array, operator, value)], "and")
+                    self.assertEqual(
+                        indexed_positions.tolist(),
+                        scanned_positions.tolist(),
+                        f"CD4 {comparator} {value}",
+                    )
+
+
+class CellIndexTestCase(TestCase):
+    def use_cell_df(self, cell_df: pd.DataFrame):
+        start_patches(self, [patch("query_app.cell_index.get_cell_df", return_value=cell_df)])
+
+    def test_duplicate_cell_ids(self):
+        modality = Modality.objects.create(modality_name="rna")
+        cell_ids = ["a", "b", "b", "c", "d"]
+        pks = [Cell.objects.create(cell_id=cell_id, modality=modality).pk for cell_id in cell_ids]
+        # Sorted by cell ID, the zarr rows are in another order and "d" has no row
+        self.use_cell_df(pd.DataFrame({"cell_id": ["a", "b", "c"], "int_index": [2, 0, 1]}))
+        self.assertEqual(get_position_pks("rna").tolist(), [pks[1], pks[3], pks[0]])
+        self.assertEqual(positions_to_pks("rna", np.array([0])).tolist(), pks[1:3])
+        self.assertEqual(positions_to_pks("rna", np.array([0, 1, 2])).tolist(), pks[:4])
+        found, positions = pks_to_positions("rna", np.array(pks))
+        self.assertEqual(found.tolist(), [True, True, True, True, False])
+        self.assertEqual(positions.tolist(), [2, 0, 0, 1])
+
+    def test_trailing_rows_without_cells(self):
+        modality = Modality.objects.create(modality_name="rna")
+        pks = [Cell.objects.create(cell_id=cell_id, modality=modality).pk for cell_id in "ab"]
+        # Zarr rows 2 and 3 belong to cells left out of the cell DataFrame
+        self.use_cell_df(pd.DataFrame({"cell_id": ["a", "b"], "int_index": [0, 1]}))
+        zarr_root = zarr.group()
+        zarr_root.array("rna/CD4", np.array([0.0, 2.0, 2.0, 2.0]), chunks=(2,))
+        with patch.dict("query_app.data_registry.data_registry.tables", {"zarr_root": zarr_root}):
+            positions = get_conditions_positions("rna", [["CD4", ">", "1"]], "and")
+        self.assertEqual(positions.tolist(), [1, 2, 3])
+        self.assertEqual(positions_to_pks("rna", positions).tolist(), [pks[1]])
+
+
+class ChunkMomentsTestCase(SimpleTestCase):
+    def get_moments(self, values: np.ndarray, positions: np.ndarray):
+        """Moments of the values at the positions, from chunk summaries where possible,
+        along with the positions read from the array"""
+        zarr_root = zarr.group()
+        zarr_root.array("rna/CD4", values, chunks=(100,))
+        build_chunk_summaries(zarr_root, "rna", "CD4")
+        tables = {"zarr_root": zarr_root}
+        with patch.dict("query_app.data_registry.data_registry.tables", tables), patch(
+            "query_app.analysis.read_quant_values", wraps=read_quant_values
+        ) as read_mock:
+            moments = get_var_moments("rna", "CD4", positions)
+        return moments, read_mock.call_args.args[2]
+
+    def assert_numpy_moments(self, moments: np.ndarray, selected: np.ndarray):
+        expected_values = {
+            "mean": np.nanmean(selected),
+            "min": np.nanmin(selected),
+            "max": np.nanmax(selected),
+            "stddev": np.nanstd(selected),
+        }
+        for stat_type, expected_value in expected_values.items():
+            value = get_statistic_value(moments, stat_type)
+            self.assertAlmostEqual(value, expected_value, places=6, msg=stat_type)
+
+    def test_chunk_moments_match_numpy(self):
+        rng = np.random.default_rng(0)
+        # A spread small next to the mean, which a sum of squares would lose to cancellation
+        values = 1e8 + rng.normal(0.0, 1.0, 1000)
+        values[::13] = np.nan
+        # Whole chunks 1 through 4, and the edges of chunks 0 and 5
+        positions = np.arange(50, 550)
+        moments, read_positions = self.get_moments(values, positions)
+        self.assertEqual(len(read_positions), 100)
+        self.assert_numpy_moments(moments, values[positions])
+
+    def test_repeated_positions(self):
+        values = np.random.default_rng(0).normal(5.0, 2.0, 1000)
+        # Half of chunk 1 twice over, as many positions as the chunk has rows, and all of
+        # chunk 3 with one of its rows shared by three cells
+        positions = np.concatenate(
+            [np.arange(100, 150), np.arange(100, 150), np.arange(300, 400), [350, 350]]
+        )
+        moments, read_positions = self.get_moments(values, positions)
+        self.assertEqual(sorted(read_positions), sorted(positions[:100].tolist() + [350, 350]))
+        self.assert_numpy_moments(moments, values[positions])
@@ -0,0 +1,46 @@
+import os
+import resource
+from contextlib import contextmanager
+from time import perf_counter
+
+# Duration and resident memory of each phase of app initialization and of each table load,
+# in order. Workers forked from a preloading uwsgi master inherit the master's phases
+phase_timings = []
+
+
+def get_rss():
+    """-> int
+    Current resident set size of this process in bytes. Falls back to the peak resident size
+    where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (FileNotFoundError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def timed_phase(name: str):
+    """Records the wall time and the change in resident memory of the enclosed block.
+    Other threads allocating at the same time are counted in the memory change"""
+    start_rss = get_rss()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        rss = get_rss()
+        phase_timings.append(
+            {
+                "phase": name,
+                "seconds": round(perf_counter() - start, 3),
+                "rss_delta_bytes": rss - start_rss,
+                "rss_bytes": rss,
+                "pid": os.getpid(),
+            }
+        )
+
+
+def get_phase_timings():
+    """-> List[dict]"""
+    return list(phase_timings)
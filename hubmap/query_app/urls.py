@@ -35,6 +35,7 @@ urlpatterns = [
     path("min/", views.StatisticViewSet.as_view(), name="set_min"),
     path("max/", views.StatisticViewSet.as_view(), name="set_max"),
     path("stddev/", views.StatisticViewSet.as_view(), name="set_max"),
+    path("stats/", views.BatchStatisticViewSet.as_view(), name="set_stats"),
     path(
         "cellevaluation/",
         views.CellListEvaluationViewSet.as_view({"post": "post"}),
@@ -1,19 +1,24 @@
 import hashlib
 import json
 import pickle
+import zlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
+from time import time
 from typing import List
 
+import numpy as np
 from django.conf import settings
 from django.db import connections
 from django.db.utils import OperationalError
 from django.http import HttpResponse
-from pymongo import MongoClient
 
 from .apps import count_dict
+from .handle_store import get_handle_store, handle_cache
 from .models import Cell, CellType, Cluster, Dataset, Gene, Organ, Protein
+from .timing import get_phase_timings
 
 
 def set_intersection(query_set_1, query_set_2):
@@ -24,34 +29,119 @@ def set_union(query_set_1, query_set_2):
     return query_set_1 | query_set_2
 
 
-def make_pickle_and_hash(qs, set_type):
-    client = MongoClient(settings.MONGO_HOST_AND_PORT)
-    collection = client[settings.MONGO_DB_NAME][settings.MONGO_COLLECTION_NAME]
+def encode_cell_pks(pks) -> bytes:
+    """Iterable[int] -> bytes
+    Packs a set of Cell primary keys into a compact bitmap-like blob: the keys are sorted,
+    delta-encoded and compressed, so that runs of consecutive keys cost almost nothing"""
+    pks = np.unique(np.asarray(pks, dtype=np.int64))
+    deltas = np.diff(pks, prepend=0).astype(np.uint32)
+    return zlib.compress(deltas.tobytes())
 
+
+def decode_cell_pks(blob: bytes) -> np.ndarray:
+    """bytes -> np.ndarray
+    Inverse of encode_cell_pks(), returns a sorted array of unique Cell primary keys"""
+    deltas = np.frombuffer(zlib.decompress(blob), dtype=np.uint32)
+    return np.cumsum(deltas, dtype=np.int64)
+
+
+def materialize_cell_pks(qs) -> np.ndarray:
+    pks = qs.values_list("pk", flat=True).iterator()
+    return np.unique(np.fromiter(pks, dtype=np.int64))
+
+
+def handle_is_fresh(query_handle):
+    """str -> bool
+    Whether this process already knows the handle, with at least half of its lifetime left.
+    Writing such a handle again can be skipped entirely"""
+    expires_at = handle_cache.get_expiry(query_handle)
+    return expires_at is not None and expires_at - time() > settings.TOKEN_EXPIRATION_TIME / 2
+
+
+def make_pickle_and_hash(qs, set_type, cell_pks=None, count_bounds=None):
     qry = qs.query
     query_pickle = pickle.dumps(qry)
     query_handle = str(hashlib.sha256(query_pickle).hexdigest())
 
+    if handle_is_fresh(query_handle):
+        return query_handle
+
     doc = {
         "query_handle": query_handle,
         "query_pickle": query_pickle,
         "set_type": set_type,
         "created_at": datetime.utcnow(),
     }
-    collection.insert_one(doc)
 
-    return query_handle
+    if set_type == "cell" and settings.MATERIALIZE_CELL_HANDLES:
+        if cell_pks is None:
+            cell_pks = materialize_cell_pks(qs)
+        cell_pks_blob = encode_cell_pks(cell_pks)
+        # Very large sets stay query-only, documents in the store are capped in size
+        if len(cell_pks_blob) <= settings.MAX_MATERIALIZED_CELL_BYTES:
+            doc["cell_pks"] = cell_pks_blob
+            doc["count"] = len(cell_pks)
 
+    if "count" not in doc and count_bounds is not None:
+        doc["count_bounds"] = list(count_bounds)
 
-def unpickle_query_set(query_handle):
-    client = MongoClient(settings.MONGO_HOST_AND_PORT)
-    collection = client[settings.MONGO_DB_NAME][settings.MONGO_COLLECTION_NAME]
+    get_handle_store().put(doc)
+    cache_handle_entry(doc, query=qry.clone())
+
+    if "count" not in doc and settings.ASYNC_HANDLE_COUNTS:
+        from .tasks import fill_handle_count
+
+        fill_handle_count.delay(query_handle)
 
-    query_object = collection.find_one({"query_handle": query_handle})
+    return query_handle
+
+
+def get_query_document(query_handle):
+    query_object = get_handle_store().get(query_handle)
     if query_object is None:
         raise ValueError(f"Query handle {query_handle} is not valid")
-    query_pickle = query_object["query_pickle"]
-    set_type = query_object["set_type"]
+    return query_object
+
+
+def cache_handle_entry(query_object, query=None):
+    """Decodes a handle store document into the entry kept in the local handle cache,
+    which expires together with the document itself"""
+    if query is None:
+        query = pickle.loads(query_object["query_pickle"])
+    cell_pks = None
+    if "cell_pks" in query_object:
+        cell_pks = decode_cell_pks(query_object["cell_pks"])
+        cell_pks.setflags(write=False)
+
+    count_bounds = query_object.get("count_bounds")
+    entry = {
+        "query": query,
+        "set_type": query_object["set_type"],
+        "cell_pks": cell_pks,
+        "count": query_object.get("count"),
+        "count_bounds": None if count_bounds is None else tuple(count_bounds),
+    }
+    created_at = query_object["created_at"].replace(tzinfo=timezone.utc).timestamp()
+    size = 0 if cell_pks is None else cell_pks.nbytes
+    handle_cache.put(
+        query_object["query_handle"],
+        entry,
+        expires_at=created_at + settings.TOKEN_EXPIRATION_TIME,
+        size=size,
+    )
+    return entry
+
+
+def get_handle_entry(query_handle):
+    entry = handle_cache.get(query_handle)
+    if entry is None:
+        entry = cache_handle_entry(get_query_document(query_handle))
+    return entry
+
+
+def unpickle_query_set(query_handle):
+    entry = get_handle_entry(query_handle)
+    set_type = entry["set_type"]
 
     if set_type == "cell":
         qs = Cell.objects.all()
@@ -74,11 +164,68 @@ def unpickle_query_set(query_handle):
     elif set_type == "cell_type":
         qs = CellType.objects.all()
 
-    qs.query = pickle.loads(query_pickle)
+    qs.query = entry["query"].clone()
 
     return qs, set_type
 
 
+def get_cell_pks(query_handle):
+    """str -> Optional[np.ndarray]
+    Returns the sorted Cell primary keys stored alongside a cell handle,
+    or None if the handle was not materialized"""
+    return get_handle_entry(query_handle)["cell_pks"]
+
+
+def get_count_bounds(query_handle):
+    """str -> Optional[Tuple[int, int]]
+    Returns the bounds on the size of a handle's set that are known without running its query,
+    (count, count) once the exact count is known, or None if nothing is known"""
+    if query_handle in count_dict:
+        return count_dict[query_handle], count_dict[query_handle]
+    entry = get_handle_entry(query_handle)
+    if entry["count"] is not None:
+        return entry["count"], entry["count"]
+    return entry["count_bounds"]
+
+
+def save_handle_count(query_handle, count):
+    get_handle_store().update(query_handle, {"count": count})
+    entry = get_handle_entry(query_handle)
+    entry["count"] = count
+
+
+def save_handle_cell_pks(query_handle, cell_pks):
+    """Keeps the primary keys of a cell handle stored without them, e.g. the precomputed
+    dataset and modality handles, once they have been read from the database. They're added
+    to the stored document within MAX_MATERIALIZED_CELL_BYTES, and to this process's handle
+    cache in any case"""
+    cell_pks.setflags(write=False)
+    if settings.MATERIALIZE_CELL_HANDLES:
+        cell_pks_blob = encode_cell_pks(cell_pks)
+        if len(cell_pks_blob) <= settings.MAX_MATERIALIZED_CELL_BYTES:
+            fields = {"cell_pks": cell_pks_blob, "count": len(cell_pks)}
+            get_handle_store().update(query_handle, fields)
+    entry = get_handle_entry(query_handle)
+    entry["cell_pks"] = cell_pks
+    entry["count"] = len(cell_pks)
+    expires_at = handle_cache.get_expiry(query_handle)
+    if expires_at is not None:
+        # Put again to account for the size of the keys
+        handle_cache.put(query_handle, entry, expires_at=expires_at, size=cell_pks.nbytes)
+
+
+def get_handle_count(query_handle):
+    """str -> int
+    Counts a handle's set once, later calls read the count persisted next to the handle"""
+    count_bounds = get_count_bounds(query_handle)
+    if count_bounds is not None and count_bounds[0] == count_bounds[1]:
+        return count_bounds[0]
+    query_set, set_type = unpickle_query_set(query_handle)
+    count = query_set.count()
+    save_handle_count(query_handle, count)
+    return count
+
+
 def get_database_status():
     db_conn = connections["default"]
     try:
@@ -101,6 +248,9 @@ def get_app_status():
             with open(path) as f:
                 json_dict = json.load(f)
                 json_dict["postgres_connection"] = get_database_status()
+                json_dict["handle_store"] = get_handle_store().stats()
+                json_dict["handle_cache"] = handle_cache.stats()
+                json_dict["startup_phases"] = get_phase_timings()
                 return json.dumps(json_dict)
         except FileNotFoundError:
             pass
@@ -152,11 +302,30 @@ def split_at_comparator(item: str) -> List:
     return []
 
 
-def get_response_from_query_handle(query_handle: str, set_type: str):
+def encode_cursor(kind: str, value) -> str:
+    """str, Union[int, str] -> str
+    Opaque token pointing at the page after the one just evaluated, either an "offset" into
+    sets that are sliced from arrays, or the value of the distinct field to continue "after" """
+    return urlsafe_b64encode(json.dumps([kind, value]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        kind, value = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError(f"Cursor {cursor} is not valid")
+    if kind not in {"offset", "after"}:
+        raise ValueError(f"Cursor {cursor} is not valid")
+    return kind, value
+
+
+def get_response_from_query_handle(query_handle: str, set_type: str, count_bounds=None):
     query_dict = {}
     query_dict["query_handle"] = query_handle
     set_type = "cell_type" if set_type == "celltype" else set_type
     query_dict["set_type"] = set_type
+    if count_bounds is not None:
+        query_dict["count_bounds"] = list(count_bounds)
     response_dict = {}
     response_dict["count"] = 1
     response_dict["next"] = None
@@ -168,11 +337,10 @@ def get_response_from_query_handle(query_handle: str, set_type: str):
 def get_response_with_count_from_query_handle(query_handle: str):
     query_dict = {}
     query_dict["query_handle"] = query_handle
-    query_set, set_type = unpickle_query_set(query_handle)
+    set_type = get_handle_entry(query_handle)["set_type"]
     set_type = "cell_type" if set_type == "celltype" else set_type
     query_dict["set_type"] = set_type
-    count = count_dict[query_handle] if query_handle in count_dict else query_set.count()
-    query_dict["count"] = count
+    query_dict["count"] = get_handle_count(query_handle)
     response_dict = {}
     response_dict["count"] = 1
     response_dict["next"] = None
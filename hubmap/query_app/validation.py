@@ -4,7 +4,7 @@ from django.conf import settings
 from django.contrib.postgres.search import TrigramSimilarity
 from django.db.models.functions import Upper
 
-from .apps import zarr_root
+from .data_registry import get_table
 from .models import Cell, CellType, Cluster, Dataset, Gene, Modality, Organ, Protein
 from .utils import infer_values_type, split_at_comparator, unpickle_query_set
 
@@ -321,14 +321,14 @@ def process_input_set(input_set: List, input_type: str):
 def validate_list_evaluation_args(query_params):
 
     required_fields = {"key", "set_type", "limit"}
-    permitted_fields = required_fields | {"offset"}
+    permitted_fields = required_fields | {"offset", "cursor"}
     check_parameter_fields(query_params, required_fields, permitted_fields)
 
 
 def validate_detail_evaluation_args(query_params):
 
     required_fields = {"key", "set_type", "limit"}
-    permitted_fields = required_fields | {"offset", "sort_by", "values_included"}
+    permitted_fields = required_fields | {"offset", "cursor", "sort_by", "values_included"}
     check_parameter_fields(query_params, required_fields, permitted_fields)
     if "values_included" in query_params and len(query_params["values_included"]) > 0:
         values_type = infer_values_type(query_params["values_included"])
@@ -475,10 +475,40 @@ def validate_input_terms(input_type: str, input_set: List[str]):
 
 
 def validate_gene_modality(gene_symbol, modality):
-    modality_group = zarr_root[modality]
+    modality_group = get_table("zarr_root")[modality]
     other_modality_dict = {"rna": "atac", "atac": "rna"}
     gene_symbols = list(modality_group.array_keys())
     other_modality = other_modality_dict[modality]
     if modality in ["rna", "atac"]:
         if gene_symbol not in gene_symbols:
             raise ValueError(f"{gene_symbol} not present in {modality} only in {other_modality}")
+
+
+def validate_batch_statistic_args(query_params):
+    required_fields = {"key", "set_type", "var_ids", "stat_types"}
+    permitted_fields = required_fields
+    check_parameter_fields(query_params, required_fields, permitted_fields)
+
+    permitted_set_types = ["cell"]
+    set_type = query_params["set_type"]
+    if set_type not in permitted_set_types:
+        raise ValueError(f"{set_type} not supported, only {permitted_set_types}")
+
+    if len(query_params["var_ids"]) == 0:
+        raise ValueError("At least one var_id is required")
+
+    if len(query_params["stat_types"]) == 0:
+        raise ValueError("At least one stat_type is required")
+
+    permitted_stat_types = ["mean", "min", "max", "stddev"]
+    permitted_stat_types.sort()
+    for stat_type in query_params["stat_types"]:
+        if stat_type not in permitted_stat_types:
+            raise ValueError(f"{stat_type} not supported, only {permitted_stat_types}")
+
+    return (
+        query_params["key"],
+        query_params["set_type"],
+        query_params["var_ids"],
+        query_params["stat_types"],
+    )
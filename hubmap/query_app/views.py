@@ -1,18 +1,25 @@
 import json
 import traceback
+from itertools import chain, islice
 from time import perf_counter
 from typing import Callable
 
 import django.core.serializers
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import redirect
 from django.views import View
 from rest_framework import viewsets
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from .analysis import calculate_statistics, get_bounds
+from .analysis import calculate_batch_statistics, calculate_statistics, get_bounds
 from .models import Cell, CellType, Cluster, Dataset, Gene, Organ, Protein
 from .queries import (
     cell_query,
@@ -23,6 +30,7 @@ from .queries import (
     organ_query,
     protein_query,
 )
+from .renderers import ArrowRenderer, NDJSONRenderer, ParquetRenderer, iter_ndjson
 from .serializers import (
     CellAndValuesSerializer,
     CellSerializer,
@@ -37,7 +45,15 @@ from .serializers import (
     OrganSerializer,
     ProteinSerializer,
 )
-from .set_evaluators import evaluation_detail, evaluation_list, query_set_count
+from .set_evaluators import (
+    evaluation_detail,
+    evaluation_detail_frame,
+    evaluation_detail_stream,
+    evaluation_list,
+    evaluation_list_frame,
+    evaluation_list_stream,
+    query_set_count,
+)
 from .set_operators import query_set_difference, query_set_intersection, query_set_union
 from .utils import get_app_status
 
@@ -49,6 +65,20 @@ class PaginationClass(PageNumberPagination):
     max_page_size = settings.MAX_PAGE_SIZE
 
 
+# Evaluations can also be requested as NDJSON, which streams the records in batches
+evaluation_renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+stream_callables = {
+    evaluation_list: evaluation_list_stream,
+    evaluation_detail: evaluation_detail_stream,
+}
+# Cell evaluations can be requested as Arrow or Parquet, built from the cell DataFrames
+cell_evaluation_renderer_classes = evaluation_renderer_classes + [ArrowRenderer, ParquetRenderer]
+frame_callables = {
+    evaluation_list: evaluation_list_frame,
+    evaluation_detail: evaluation_detail_frame,
+}
+
+
 def get_generic_response(self, callable, request):
     try:
         return JsonResponse(callable(self, request), safe=False)
@@ -91,13 +121,39 @@ def operation(self, request):
     return get_generic_response(self, callable, request)
 
 
+def wants_stream(request) -> bool:
+    accepted_renderer = getattr(request, "accepted_renderer", None)
+    return isinstance(accepted_renderer, NDJSONRenderer)
+
+
 def get_response(self, request, callable: Callable):
     try:
+        if wants_stream(request) and callable in stream_callables:
+            batches = iter(stream_callables[callable](self, request))
+            # Handles and cursors are resolved when the first batch is evaluated, which has to
+            # happen here for invalid ones to get an error response rather than a cut-off stream
+            first_batches = list(islice(batches, 1))
+            return StreamingHttpResponse(
+                iter_ndjson(chain(first_batches, batches)),
+                content_type=NDJSONRenderer.media_type,
+            )
+        accepted_renderer = getattr(request, "accepted_renderer", None)
+        if isinstance(accepted_renderer, (ArrowRenderer, ParquetRenderer)):
+            page_df = frame_callables[callable](self, request)
+            response = HttpResponse(
+                accepted_renderer.render(page_df), content_type=accepted_renderer.media_type
+            )
+            if getattr(self, "next_cursor", None) is not None:
+                response["X-Next-Cursor"] = self.next_cursor
+            return response
         response = callable(self, request)
         if isinstance(response, str):
             return HttpResponse(response)
         paginated_queryset = self.paginate_queryset(response)
         paginated_response = self.get_paginated_response(paginated_queryset)
+        # Evaluations return a cursor to their next page in place of a page number link
+        if getattr(self, "next_cursor", None) is not None:
+            paginated_response.data["next"] = self.next_cursor
         return paginated_response
     except ValueError as e:
         tb = traceback.format_exc()
@@ -132,6 +188,7 @@ class CellDetailEvaluationViewSet(viewsets.ModelViewSet):
     query_set = Cell.objects.all()
     serializer_class = CellAndValuesSerializer
     pagination_class = PaginationClass
+    renderer_classes = cell_evaluation_renderer_classes
     model = Cell
 
     def post(self, request, format=None):
@@ -146,6 +203,7 @@ class OrganDetailEvaluationViewSet(viewsets.ModelViewSet):
     serializer_class = OrganAndValuesSerializer
     model = Organ
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
 
     def post(self, request, format=None):
         return get_response(self, request, evaluation_detail)
@@ -155,6 +213,7 @@ class GeneDetailEvaluationViewSet(viewsets.ModelViewSet):
     queryset = Gene.objects.all()
     serializer_class = GeneAndValuesSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
     model = Gene
 
     def post(self, request, format=None):
@@ -165,6 +224,7 @@ class ClusterDetailEvaluationViewSet(viewsets.ModelViewSet):
     queryset = Cluster.objects.all()
     serializer_class = ClusterAndValuesSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
 
     def post(self, request, format=None):
         return get_response(self, request, evaluation_detail)
@@ -174,6 +234,7 @@ class DatasetDetailEvaluationViewSet(viewsets.ModelViewSet):
     queryset = Dataset.objects.all()
     serializer_class = DatasetAndValuesSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
 
     def post(self, request, format=None):
         return get_response(self, request, evaluation_detail)
@@ -183,6 +244,7 @@ class CellListEvaluationViewSet(viewsets.ModelViewSet):
     query_set = Cell.objects.all()
     serializer_class = CellSerializer
     pagination_class = PaginationClass
+    renderer_classes = cell_evaluation_renderer_classes
     model = Cell
 
     def post(self, request, format=None):
@@ -193,6 +255,7 @@ class CellTypeListEvaluationViewSet(viewsets.ModelViewSet):
     query_set = CellType.objects.all()
     serializer_class = CellTypeSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
     model = CellType
 
     def post(self, request, format=None):
@@ -203,6 +266,7 @@ class OrganListEvaluationViewSet(viewsets.ModelViewSet):
     queryset = Organ.objects.all()
     serializer_class = OrganSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
     model = Organ
 
     def post(self, request, format=None):
@@ -213,6 +277,7 @@ class GeneListEvaluationViewSet(viewsets.ModelViewSet):
     queryset = Gene.objects.all()
     serializer_class = GeneSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
     model = Gene
 
     def post(self, request, format=None):
@@ -223,6 +288,7 @@ class ClusterListEvaluationViewSet(viewsets.ModelViewSet):
     queryset = Cluster.objects.all()
     serializer_class = ClusterSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
 
     def post(self, request, format=None):
         return get_response(self, request, evaluation_list)
@@ -232,6 +298,7 @@ class DatasetListEvaluationViewSet(viewsets.ModelViewSet):
     queryset = Dataset.objects.all()
     serializer_class = DatasetSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
 
     def post(self, request, format=None):
         return get_response(self, request, evaluation_list)
@@ -241,6 +308,7 @@ class ProteinListEvaluationViewSet(viewsets.ModelViewSet):
     queryset = Protein.objects.all()
     serializer_class = ProteinSerializer
     pagination_class = PaginationClass
+    renderer_classes = evaluation_renderer_classes
 
     def post(self, request, format=None):
         return get_response(self, request, evaluation_list)
@@ -261,6 +329,14 @@ class StatisticViewSet(APIView):
         return get_generic_response(self, calculate_statistics, request)
 
 
+class BatchStatisticViewSet(APIView):
+    pagination_class = PaginationClass
+    serializer_class = JSONSerializer
+
+    def post(self, request, format=None):
+        return get_generic_response(self, calculate_batch_statistics, request)
+
+
 class StatusViewSet(APIView):
     pagination_class = PaginationClass
     serializer_class = JSONSerializer
@@ -0,0 +1,11 @@
+# Groups of the zarr store kept alongside the per-modality arrays, written by build_value_index.py.
+# Importable without Django, for that script
+
+# Sorted value indices, i.e. /sorted/rna/CD4 indexes /rna/CD4
+SORTED_GROUP = "sorted"
+
+# Per-chunk moments, i.e. /summaries/rna/CD4 summarizes /rna/CD4 one chunk per row
+SUMMARY_GROUP = "summaries"
+# Columns of each row of the chunk summaries, which are recorded in their attributes so that
+# summaries in another layout are ignored
+SUMMARY_MOMENTS = ["count", "mean", "m2", "min", "max"]
@@ -16,6 +16,7 @@ from django.db import connection, transaction
 
 django.setup()
 
+from query_app.apps import compute_dataset_hashes
 from query_app.models import (
     Cell,
     CellType,
@@ -349,6 +350,8 @@ def main(hdf_files: List[Path]):
         if file.stem in ["rna", "atac", "codex"]:
             load_data(file)
             print(f"{file.stem} loaded")
+    compute_dataset_hashes(rebuild=True)
+    print("Dataset handle manifest written")
 
 
 if __name__ == "__main__":